@@ -0,0 +1,195 @@
+"""Compact records of the models fit by the Bayesian optimization planner
+
+Each model is saved as the settings of the model with its hyperparameters fixed, plus the data it was trained on,
+rather than as a pickle of the fitted model. The inputs of the training set are stored in segments
+shared by all iterations of a run, so that each iteration writes only the inputs added since the previous one.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from threading import Lock
+from typing import Optional, List, Tuple, Dict, Set, Callable
+import pickle as pkl
+import logging
+import shutil
+import os
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+def load_model_artifact(path: Path) -> Pipeline:
+    """Re-create a model from its artifact
+
+    Fits the model again with the saved hyperparameters, which does not require optimizing the kernel.
+
+    Args:
+        path: Path to the artifact, which must be in an iteration directory of the run
+    Returns:
+        The fitted model
+    """
+    path = Path(path)
+    data_dir = path.parent.parent / 'training-data'
+    with np.load(path) as data:
+        model = pkl.loads(data['spec'].tobytes())
+        train_x = np.concatenate([np.load(data_dir / name) for name in data['segments']])
+        train_y = data['train_y']
+    return model.fit(train_x, train_y)
+
+
+class ModelWriter:
+    """Save models in a background thread and remove old iteration directories
+
+    Models are written in the order they are submitted.
+    Iteration directories are not removed while other tasks registered with :meth:`hold` are still writing to them.
+    """
+
+    def __init__(self, run_dir: Path, keep_iterations: Optional[int] = None):
+        """
+        Args:
+            run_dir: Output directory of the run
+            keep_iterations: Number of the most recent iteration directories to keep. ``None`` to keep all
+        """
+        if keep_iterations is not None and keep_iterations < 1:
+            raise ValueError('Must keep at least one iteration directory')
+        self.run_dir = Path(run_dir)
+        self.data_dir = self.run_dir / 'training-data'
+        self.data_dir.mkdir(exist_ok=True)
+        self.keep_iterations = keep_iterations
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model-writer')
+
+        # Segments of the training inputs written so far, and the inputs they hold
+        self._segments: List[Tuple[str, int]] = []
+        self._last_x: Optional[np.ndarray] = None
+
+        # Iteration directories in use by other tasks, and the tasks using them
+        self._held: Dict[Path, Set[Future]] = {}
+        self._held_lock = Lock()
+
+    def submit(self, model: Pipeline, train_x: np.ndarray, out_dir: Path, iteration: int) -> Future:
+        """Save a model in the background
+
+        Args:
+            model: Fitted model, a pipeline ending with a Gaussian process regression step named "gpr".
+                May be modified after this function returns
+            train_x: Inputs used to train the model
+            out_dir: Iteration directory in which to write the artifact
+            iteration: Iteration number, used to name the segment of new training inputs
+        Returns:
+            Future which completes when the model is written
+        """
+        # Copy what we need now, as the model may be updated in place while we are writing
+        gpr = model['gpr']
+        spec = clone(model).set_params(gpr__kernel=gpr.kernel_, gpr__optimizer=None)
+        future = self.executor.submit(self._write, spec, train_x, gpr.y_train_, out_dir, iteration)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def run_after_writes(self, fn: Callable, *args) -> Future:
+        """Run a function once every model submitted so far has been written
+
+        Args:
+            fn: Function to run in the writer thread
+            args: Arguments to the function
+        Returns:
+            Future for the result of the function
+        """
+        return self.executor.submit(fn, *args)
+
+    def hold(self, out_dir: Path, future: Future):
+        """Keep an iteration directory until a task that writes to it has finished
+
+        Args:
+            out_dir: Iteration directory
+            future: Future for the task
+        """
+        with self._held_lock:
+            self._held.setdefault(Path(out_dir), set()).add(future)
+        future.add_done_callback(lambda f: self._release(Path(out_dir), f))
+
+    def _release(self, out_dir: Path, future: Future):
+        """Allow an iteration directory to be removed once a task is done with it
+
+        Args:
+            out_dir: Iteration directory
+            future: Future for the finished task
+        """
+        with self._held_lock:
+            futures = self._held.get(out_dir, set())
+            futures.discard(future)
+            if len(futures) == 0:
+                self._held.pop(out_dir, None)
+
+        # Remove the directory now if it is no longer among the most recent ones
+        if self.keep_iterations is not None:
+            self.executor.submit(self._remove_old_iterations)
+
+    def _write(self, spec: Pipeline, train_x: np.ndarray, train_y: np.ndarray, out_dir: Path, iteration: int):
+        """Write a model artifact and then apply the retention policy
+
+        Args:
+            spec: Unfitted model with its hyperparameters fixed
+            train_x: Inputs used to train the model
+            train_y: Outputs used to train the model, after any scaling
+            out_dir: Iteration directory in which to write the artifact
+            iteration: Iteration number
+        """
+        # Write only the inputs added since the last model, if the earlier inputs are unchanged
+        n_old = 0 if self._last_x is None else len(self._last_x)
+        if n_old == 0 or len(train_x) < n_old or not np.array_equal(train_x[:n_old], self._last_x):
+            self._segments, n_old = [], 0
+        if len(train_x) > n_old:
+            name = f'inputs-{iteration}.npy'
+            np.save(self.data_dir / name, train_x[n_old:])
+            self._segments.append((name, len(train_x) - n_old))
+        self._last_x = train_x
+
+        # Write the artifact to a temporary file, then move it into place
+        temp_path = out_dir / 'model.npz.tmp'
+        with temp_path.open('wb') as fp:
+            np.savez(fp,
+                     spec=np.frombuffer(pkl.dumps(spec), dtype=np.uint8),
+                     kernel=np.array(str(spec['gpr'].kernel)),
+                     segments=np.array([name for name, _ in self._segments]),
+                     train_y=train_y)
+        os.replace(temp_path, out_dir / 'model.npz')
+
+        self._remove_old_iterations()
+
+    def _remove_old_iterations(self):
+        """Delete all but the most recent iteration directories, and any training inputs they alone used
+
+        Directories held by unfinished tasks are kept until those tasks finish.
+        """
+        if self.keep_iterations is None:
+            return
+        with self._held_lock:
+            held = set(self._held)
+        iter_dirs = sorted(self.run_dir.glob('iteration-*'), key=lambda x: int(x.name.split('-')[-1]))
+        for iter_dir in iter_dirs[:-self.keep_iterations]:
+            if iter_dir in held:
+                logger.debug(f'Keeping {iter_dir} until the tasks writing to it finish')
+                continue
+            shutil.rmtree(iter_dir, ignore_errors=True)
+            logger.debug(f'Removed {iter_dir}')
+
+        # Find the segments still in use
+        in_use = set(name for name, _ in self._segments)
+        for path in self.run_dir.glob('iteration-*/model.npz'):
+            with np.load(path) as data:
+                in_use.update(data['segments'])
+        for path in self.data_dir.glob('inputs-*.npy'):
+            if path.name not in in_use:
+                path.unlink()
+
+    @staticmethod
+    def _log_failure(future: Future):
+        """Report if writing a model failed
+
+        Args:
+            future: Future for the write
+        """
+        if future.exception() is not None:
+            logger.warning(f'Failed to save the model: {future.exception()}')
@@ -1,27 +1,30 @@
 """Use local compute for the Parsl executor"""
 from colmena.redis.queue import TaskServerQueues
 from colmena.task_server import ParslTaskServer
-from parsl import Config, ThreadPoolExecutor
 
-from planner import run_inference
-
-config = Config(
-    executors=[ThreadPoolExecutor(max_threads=1)]
-)
+from polybot.planning import build_process_pool_executor
+from planner import run_inference, run_inference_on_range, run_acquisition, run_acquisition_on_range, \
+    run_acquisition_on_shared
 
 
 def make_task_server(queues: TaskServerQueues) -> ParslTaskServer:
     """Make the task server
 
-    Has a single method: run_inference
+    Runs tasks on a pool of processes that use every core on the machine.
+    Set ``TASK_WORKERS`` and ``TASK_WORKER_THREADS`` in the environment to control the number of workers
+    and the number of threads used by each.
+
+    Has methods for running inference (run_inference and run_inference_on_range)
+    and for finding the best points from a chunk (run_acquisition, run_acquisition_on_range,
+    and run_acquisition_on_shared)
 
     Args:
         queues: Queues to be used. Expects a single compute queue, named "compute"
     Returns:
         Initialized task server
     """
-    return ParslTaskServer(
-        queues=queues,
-        methods=[run_inference],
-        config=config
+    return build_process_pool_executor(
+        queues,
+        methods=[run_inference, run_inference_on_range, run_acquisition, run_acquisition_on_range,
+                 run_acquisition_on_shared]
     )
@@ -1,7 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime
+from functools import lru_cache
+from hashlib import sha256
 from pathlib import Path
-from typing import Tuple
+from threading import Lock
+from typing import Tuple, List, Optional, Union
 import pickle as pkl
+import heapq
+import json
+import math
+import atexit
+import shutil
+import os
 import logging
 import sys
 
@@ -9,6 +19,7 @@ import numpy as np
 from colmena.models import Result
 from colmena.redis.queue import ClientQueues
 from colmena.thinker import agent
+from sklearn.base import clone
 from sklearn.feature_selection import VarianceThreshold
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
@@ -17,16 +28,20 @@ from sklearn.model_selection import RepeatedKFold, cross_validate
 from modAL.acquisition import EI
 
 from polybot.config import settings
-from polybot.robot import send_new_sample
-from polybot.sample import load_samples, subscribe_to_study
+from polybot.robot import send_new_sample, send_new_samples
+from polybot.models import SampleCollection, SampleTemplate, SearchSpace
+from polybot.sample import coalesce_samples, subscribe_to_study, sync_study
+from polybot.store import SampleStore, IncrementalTrainingSet
 from polybot.planning import BasePlanner, OptimizationProblem
+from artifacts import ModelWriter, load_model_artifact
+from surrogates import add_training_points, make_surrogate, compile_predictor, Predictor
 
 
 def run_inference(gpr: GaussianProcessRegressor, search_x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     """Run inference on a machine learning model
 
     Args:
-        gpr: Gaussian process regression model
+        gpr: Gaussian process regression model, or a compiled :class:`Predictor`
         search_x: Search space to be evalauted
     Returns:
         - Mean of the predictions
@@ -35,19 +50,328 @@ def run_inference(gpr: GaussianProcessRegressor, search_x: np.ndarray) -> Tuple[
     return gpr.predict(search_x, return_std=True)
 
 
+def run_inference_on_range(gpr: GaussianProcessRegressor, template: SampleTemplate,
+                           chunk_start: int, chunk_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Run inference on a contiguous range of points from the search space
+
+    Generates the points on the worker so that only the template and the range
+    need to be sent with the task, rather than the points themselves.
+
+    Args:
+        gpr: Gaussian process regression model
+        template: Template that defines the search space
+        chunk_start: Index of the first point to evaluate
+        chunk_len: Number of points to evaluate
+    Returns:
+        - Mean of the predictions
+        - Standard deviation of the predictions
+    """
+    search_x = template.get_search_space(getattr(gpr, 'dtype', None)).get_chunk(chunk_start, chunk_len)
+    return run_inference(gpr, search_x)
+
+
+def select_batch(model: Pipeline, candidates: np.ndarray, batch_size: int, max_val: float,
+                 tradeoff: float = 0.1, strategy: str = 'kriging_believer') -> List[int]:
+    """Select several points to be evaluated at once
+
+    Points are chosen one at a time. After each choice, we "fantasize" an outcome for the chosen point,
+    add it to the training set of the GPR, and recompute the expected improvement of the remaining candidates.
+    The fantasy models keep the hyperparameters and preprocessing of the fitted model,
+    so each update requires only a new Cholesky factorization rather than re-optimizing the kernel.
+
+    Args:
+        model: Fitted model, a pipeline ending with a Gaussian process regression step named "gpr"
+        candidates: Points from which to select
+        batch_size: Number of points to select
+        max_val: Best value observed so far, used when computing the expected improvement
+        tradeoff: Exploration/exploitation tradeoff parameter for the expected improvement
+        strategy: How to fantasize outcomes. "kriging_believer" uses the predicted mean of the model,
+            and "constant_liar" uses the worst value in the training set
+    Returns:
+        Indices of the selected candidates, in the order they were chosen
+    """
+    if strategy not in ['kriging_believer', 'constant_liar']:
+        raise ValueError(f'Unrecognized batch strategy: {strategy}')
+
+    # Work in the space of features produced by the preprocessing steps
+    gpr: GaussianProcessRegressor = model['gpr']
+    cand_x = model[:-1].transform(candidates)
+    train_x, train_y = gpr.X_train_, gpr.y_train_
+    lie = np.min(train_y)
+
+    # Choose the first point using the fitted model
+    cand_y, cand_std = gpr.predict(cand_x, return_std=True)
+    chosen = []
+    for _ in range(min(batch_size, len(candidates))):
+        ei = EI(cand_y, cand_std, max_val=max_val, tradeoff=tradeoff)
+        ei[chosen] = -np.inf
+        best_ind = int(np.argmax(ei))
+        chosen.append(best_ind)
+        if len(chosen) == batch_size:
+            break
+
+        # Add the fantasized outcome to the training set and update the predictions
+        fantasy_y = cand_y[best_ind] if strategy == 'kriging_believer' else lie
+        train_x = np.vstack([train_x, cand_x[best_ind:best_ind + 1]])
+        train_y = np.append(train_y, fantasy_y)
+        fantasy = clone(gpr).set_params(kernel=gpr.kernel_, optimizer=None)
+        fantasy.fit(train_x, train_y)
+        cand_y, cand_std = fantasy.predict(cand_x, return_std=True)
+    return chosen
+
+
+def choose_chunk_size(n_points: int, n_workers: int, bytes_per_row: int, memory_budget: float,
+                      row_cost: Optional[float] = None, max_task_time: Optional[float] = None,
+                      chunks_per_worker: int = 4, min_chunk_size: int = 1000) -> int:
+    """Pick the number of points to evaluate in each inference task
+
+    Starts from a size which gives each worker ``chunks_per_worker`` tasks, so that workers
+    which finish early can take more work, and then shrinks the chunks so that
+    each task fits in the memory budget and, if the cost per row is known,
+    completes within ``max_task_time``.
+
+    Args:
+        n_points: Number of points in the search space
+        n_workers: Number of workers available to run tasks
+        bytes_per_row: Memory required to evaluate each point
+        memory_budget: Maximum memory to use in each task, in bytes
+        row_cost: Time required to evaluate each point, in seconds. Measured from a previous iteration
+        max_task_time: Target maximum runtime for each task, in seconds
+        chunks_per_worker: Number of tasks to create for each worker
+        min_chunk_size: Smallest chunk to create, which limits the overhead of sending many small tasks
+    Returns:
+        Number of points per chunk
+    """
+    chunk_size = math.ceil(n_points / max(n_workers * chunks_per_worker, 1))
+    chunk_size = min(chunk_size, int(memory_budget // bytes_per_row))
+    if row_cost is not None and row_cost > 0 and max_task_time is not None:
+        chunk_size = min(chunk_size, int(max_task_time / row_cost))
+    return max(chunk_size, min(min_chunk_size, n_points), 1)
+
+
+def screen_candidates(gpr: GaussianProcessRegressor, search_x: np.ndarray, max_val: float, tradeoff: float,
+                      top_k: int, exclude: Optional[np.ndarray] = None,
+                      block_size: int = 4096) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the points with the largest expected improvement, computing the uncertainty for as few points as possible
+
+    Predicting the standard deviation costs O(n^2) per point for a training set of n points,
+    while predicting the mean costs only O(n). So, we first compute the mean for every point and
+    an upper bound of the expected improvement from the prior standard deviation (which is never smaller
+    than the posterior standard deviation). Then, we compute the exact expected improvement in order of decreasing
+    upper bound, stopping once the upper bounds of the remaining points are below the top k exact values.
+    The result is identical to :meth:`run_acquisition` without screening.
+
+    Args:
+        gpr: Compiled model, or a model that can be compiled with :meth:`compile_predictor`
+        search_x: Search space to be evaluated
+        max_val: Best value observed so far
+        tradeoff: Exploration/exploitation tradeoff parameter for the expected improvement
+        top_k: Number of points to return
+        exclude: Indices of points within ``search_x`` to never select
+        block_size: Number of points for which to compute the exact expected improvement at a time
+    Returns:
+        - Indices of the best points within ``search_x``, not in any particular order
+        - Expected improvement for each of those points
+    """
+    # Compute the upper bound using only the mean and the diagonal of the kernel
+    if not isinstance(gpr, Predictor):
+        gpr = compile_predictor(gpr)
+    features = gpr.transform(search_x)
+    search_y = gpr.predict_features(features)
+    prior_std = gpr.prior_std(features)
+    upper = EI(search_y, prior_std, max_val=max_val, tradeoff=tradeoff)
+    if exclude is not None:
+        upper[exclude] = -np.inf
+    order = np.argsort(-upper)
+    order = order[:np.isfinite(upper).sum()]
+
+    # Compute the exact values until the rest of the points cannot be in the top k
+    best_inds = np.zeros((0,), dtype=np.int64)
+    best_ei = np.zeros((0,))
+    for start in range(0, len(order), block_size):
+        if len(best_ei) >= top_k and best_ei.min() >= upper[order[start]]:
+            break
+        inds = order[start:start + block_size]
+        _, search_std = gpr.predict_features(features[inds], return_std=True)
+        ei = EI(search_y[inds], search_std, max_val=max_val, tradeoff=tradeoff)
+        best_inds = np.concatenate([best_inds, inds])
+        best_ei = np.concatenate([best_ei, ei])
+        if len(best_ei) > top_k:
+            keep = np.argpartition(-best_ei, top_k - 1)[:top_k]
+            best_inds, best_ei = best_inds[keep], best_ei[keep]
+    return best_inds, best_ei
+
+
+def run_acquisition(gpr: GaussianProcessRegressor, search_x: np.ndarray, max_val: float, tradeoff: float,
+                    top_k: int, exclude: Optional[np.ndarray] = None, screen: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the points with the largest expected improvement
+
+    Args:
+        gpr: Gaussian process regression model
+        search_x: Search space to be evaluated
+        max_val: Best value observed so far
+        tradeoff: Exploration/exploitation tradeoff parameter for the expected improvement
+        top_k: Number of points to return
+        exclude: Indices of points within ``search_x`` to never select
+        screen: Whether to skip computing the uncertainty for points that cannot be among the best.
+            See :meth:`screen_candidates`
+    Returns:
+        - Indices of the best points within ``search_x``, not in any particular order
+        - Expected improvement for each of those points
+    """
+    if screen:
+        return screen_candidates(gpr, search_x, max_val, tradeoff, top_k, exclude)
+
+    search_y, search_std = run_inference(gpr, search_x)
+    ei = EI(search_y, search_std, max_val=max_val, tradeoff=tradeoff)
+    if exclude is not None:
+        ei[exclude] = -np.inf
+    n_valid = int(np.isfinite(ei).sum())
+    if top_k < n_valid:
+        best_inds = np.argpartition(-ei, top_k - 1)[:top_k]
+    else:
+        best_inds = np.flatnonzero(np.isfinite(ei))
+    return best_inds, ei[best_inds]
+
+
+def merge_best_points(best_points: List[Tuple[float, int]], chunk_start: int, inds: np.ndarray,
+                      scores: np.ndarray, top_k: int):
+    """Add the best points from one chunk of the search space to the best points found so far
+
+    Args:
+        best_points: Min-heap of the expected improvement and index in the search space of the best points so far.
+            Updated in place
+        chunk_start: Index of the first point in the chunk
+        inds: Indices of the best points within the chunk
+        scores: Expected improvement for each of those points
+        top_k: Number of points to keep
+    """
+    for ind, score in zip(inds, scores):
+        item = (float(score), chunk_start + int(ind))
+        if len(best_points) < top_k:
+            heapq.heappush(best_points, item)
+        else:
+            heapq.heappushpop(best_points, item)
+
+
+def run_acquisition_on_range(gpr: GaussianProcessRegressor, template: SampleTemplate, chunk_start: int,
+                             chunk_len: int, max_val: float, tradeoff: float, top_k: int,
+                             exclude: Optional[np.ndarray] = None, screen: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the points with the largest expected improvement from a contiguous range of the search space
+
+    Args:
+        gpr: Gaussian process regression model
+        template: Template that defines the search space
+        chunk_start: Index of the first point to evaluate
+        chunk_len: Number of points to evaluate
+        max_val: Best value observed so far
+        tradeoff: Exploration/exploitation tradeoff parameter for the expected improvement
+        top_k: Number of points to return
+        exclude: Indices of points within the range to never select
+        screen: Whether to skip computing the uncertainty for points that cannot be among the best
+    Returns:
+        - Indices of the best points within the range, not in any particular order
+        - Expected improvement for each of those points
+    """
+    search_x = template.get_search_space(getattr(gpr, 'dtype', None)).get_chunk(chunk_start, chunk_len)
+    return run_acquisition(gpr, search_x, max_val, tradeoff, top_k, exclude, screen)
+
+
+@lru_cache(maxsize=1)
+def _load_shared_model(model_path: str) -> Predictor:
+    """Load a model from disk, caching the most recent one so that it is read only once per worker
+
+    Args:
+        model_path: Path to the pickled model
+    Returns:
+        The model
+    """
+    with open(model_path, 'rb') as fp:
+        return pkl.load(fp)
+
+
+def run_acquisition_on_shared(model_path: str, search_path: str, chunk_start: int, chunk_len: int,
+                              max_val: float, tradeoff: float, top_k: int, exclude: Optional[np.ndarray] = None,
+                              screen: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the points with the largest expected improvement, reading the model and search space from shared files
+
+    Intended for workers on the same node as the planner. The search space is memory-mapped,
+    so only the points in the chunk are read and none are copied between processes.
+
+    Args:
+        model_path: Path to the pickled model. Files must not be modified after being written
+        search_path: Path to the search space, stored in ``.npy`` format
+        chunk_start: Index of the first point to evaluate
+        chunk_len: Number of points to evaluate
+        max_val: Best value observed so far
+        tradeoff: Exploration/exploitation tradeoff parameter for the expected improvement
+        top_k: Number of points to return
+        exclude: Indices of points within the range to never select
+        screen: Whether to skip computing the uncertainty for points that cannot be among the best
+    Returns:
+        - Indices of the best points within the range, not in any particular order
+        - Expected improvement for each of those points
+    """
+    gpr = _load_shared_model(model_path)
+    search_x = np.load(search_path, mmap_mode='r')[chunk_start:chunk_start + chunk_len]
+    return run_acquisition(gpr, search_x, max_val, tradeoff, top_k, exclude, screen)
+
+
 class BOPlanner(BasePlanner):
     """Use Bayesian optimization to select the next experiment"""
 
-    def __init__(self, queues: ClientQueues, opt_spec: OptimizationProblem, daemon: bool = False):
+    def __init__(self, queues: ClientQueues, opt_spec: OptimizationProblem, daemon: bool = False,
+                 resume_dir: Optional[Union[str, Path]] = None):
+        """
+        Args:
+            queues: Queues used to communicate with the task server
+            opt_spec: Definition of the optimization problem
+            daemon: Whether to launch the planner as a daemon thread
+            resume_dir: Output directory of a previous run. If provided, the planner continues from
+                the last checkpoint in that directory and writes new results there
+        """
         super().__init__(queues, opt_spec, daemon=daemon)
 
-        # Make a storage directory
-        self.output_dir = Path.cwd() / 'runs' / f'{datetime.now().strftime("%d%b%y-%H%M%S")}'
-        self.output_dir.mkdir(parents=True, exist_ok=False)
+        # Make a storage directory, or use the one from the previous run
+        if resume_dir is None:
+            self.output_dir = Path.cwd() / 'runs' / f'{datetime.now().strftime("%d%b%y-%H%M%S")}'
+            self.output_dir.mkdir(parents=True, exist_ok=False)
+        else:
+            self.output_dir = Path(resume_dir).absolute()
+            if not self.output_dir.is_dir():
+                raise ValueError(f'No such run directory: {resume_dir}')
 
         # Keep track of the iteration number
         self.iteration = 0
 
+        # Run one iteration at a time, as the cold-start and the result handler share the model and training set
+        self.bo_lock = Lock()
+
+        # Keep the latest model and the training set it was fit on, so that it can be updated incrementally
+        self.model: Optional[Pipeline] = None
+        self.model_train_x: Optional[np.ndarray] = None
+        self.model_path: Optional[Path] = None  # Artifact of the latest model
+        self.n_since_refit = 0  # Number of points added since the hyperparameters were last optimized
+        self.refit_lml = None  # Log-marginal likelihood per point at the last optimization
+
+        # Measured cost of inference from the previous iteration, used to pick the chunk size
+        self.inference_row_cost: Optional[float] = None
+
+        # Remove the files shared with workers, even if the planner thread is killed at exit
+        atexit.register(self._remove_shared_dir)
+
+        # Run cross-validation in the background, off the path between receiving a result and sending a new sample
+        self.cv_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Save the models in the background too, keeping only the latest ``keep_iterations`` iteration directories
+        self.model_writer = ModelWriter(self.output_dir, opt_spec.planner_options.get('keep_iterations'))
+
+        # Keep a local copy of the samples, which persists between runs by default
+        store_path = settings.sample_store_path or self.output_dir.parent / 'samples.db'
+        self.store = SampleStore(store_path, settings.adc_study_id)
+        self.training_set = IncrementalTrainingSet(self.store, opt_spec.search_template.input_columns,
+                                                   opt_spec.output, find_failed=self._find_failed)
+
         # Save the optimization specification
         with self.output_dir.joinpath('opt_spec.json').open('w') as fp:
             print(opt_spec.json(indent=2), file=fp)
@@ -68,22 +392,111 @@ class BOPlanner(BasePlanner):
         logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             level=logging.DEBUG, handlers=handlers)
 
+        # Restore the state of the previous run
+        self.resumed = False
+        if resume_dir is not None and self.checkpoint_path.is_file():
+            self._load_checkpoint()
+
+    @property
+    def checkpoint_path(self) -> Path:
+        """Path to the latest checkpoint of the planner"""
+        return self.output_dir / 'checkpoint.json'
+
+    def _save_checkpoint(self) -> Future:
+        """Save the state of the planner needed to resume it
+
+        Records only the iteration counter, how many samples from the store are in the training set,
+        and which model artifact holds the latest model. The training set and model are rebuilt from those on resume.
+
+        Returns:
+            Future which completes when the checkpoint is written, which happens after the model artifact is written
+        """
+        state = {
+            'iteration': self.iteration,
+            'model_path': None if self.model_path is None else str(self.model_path.relative_to(self.output_dir)),
+            'n_since_refit': self.n_since_refit,
+            'refit_lml': self.refit_lml,
+            'inference_row_cost': self.inference_row_cost,
+            'training_last_sequence': self.training_set.last_sequence,
+        }
+        return self.model_writer.run_after_writes(self._write_checkpoint, state)
+
+    def _write_checkpoint(self, state: dict):
+        """Write the checkpoint to a temporary file and then move it into place,
+        so that a crash while writing never corrupts the previous checkpoint
+
+        Args:
+            state: State of the planner
+        """
+        temp_path = self.checkpoint_path.with_suffix('.tmp')
+        with temp_path.open('w') as fp:
+            json.dump(state, fp)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _load_checkpoint(self):
+        """Restore the state of the planner from the checkpoint"""
+        with self.checkpoint_path.open() as fp:
+            state = json.load(fp)
+        self.iteration = state['iteration']
+        self.n_since_refit = state['n_since_refit']
+        self.refit_lml = state['refit_lml']
+        self.inference_row_cost = state['inference_row_cost']
+
+        # Re-read the samples that were in the training set
+        last_sequence = state['training_last_sequence']
+        self.training_set.update(until=last_sequence)
+        self.resumed = True
+        self.logger.info(f'Resumed from {self.checkpoint_path} at iteration {self.iteration}'
+                         f' with {len(self.training_set.samples)} samples')
+
+        # Re-create the latest model, which was trained on that training set
+        if state['model_path'] is None:
+            return
+        model_path = self.output_dir / state['model_path']
+        if self.training_set.last_sequence != last_sequence:
+            self.logger.warning('Samples from the previous run are missing from the store. Fitting a new model')
+        elif not model_path.is_file():
+            self.logger.warning(f'No model found at {model_path}. Fitting a new model')
+        else:
+            self.model = load_model_artifact(model_path)
+            self.model_train_x, _, _ = self.training_set.get_arrays()
+            self.model_path = model_path
+
     @agent(critical=False)
     def startup(self):
         """A thread that just performs a standard"""
-        if self.opt_spec.planner_options.get('cold_start', True):
+        # Download only the samples that are not yet in the local store
+        sync_study(self.store)
+
+        # No need to plan again after resuming, unless samples have arrived since the checkpoint
+        if self.resumed and self.store.last_sequence <= self.training_set.last_sequence:
+            self.logger.info('No new samples since the checkpoint. Skipping the cold-start')
+        elif self.opt_spec.planner_options.get('cold_start', True):
             self.logger.info('Performing a cold-start')
             self.perform_bo()
 
     @agent()
     def robot_result_handler(self):
-        for sample in subscribe_to_study():
+        # Combine results that arrive together or while we are busy, so we perform one update for all of them
+        options = self.opt_spec.planner_options
+        for samples in coalesce_samples(subscribe_to_study(store=self.store),
+                                        debounce=options.get('debounce_window', 0),
+                                        max_delay=options.get('max_debounce_delay')):
+            self.logger.info(f'Received {len(samples)} new samples')
             self.perform_bo()
 
     def perform_bo(self):
+        """Select new samples using the latest data
+
+        Waits for any iteration already in progress to finish first
+        """
+        with self.bo_lock:
+            self._perform_bo()
+
+    def _perform_bo(self):
         # Make the output directory for results
         out_dir = self.output_dir / f'iteration-{self.iteration}'
-        out_dir.mkdir()
+        out_dir.mkdir(exist_ok=True)  # May exist if the previous run stopped during this iteration
 
         # Increment the iteration number
         self.iteration += 1
@@ -99,57 +512,232 @@ class BOPlanner(BasePlanner):
         # Fit a model and save the training records
         model = self._fit_model(train_x, train_y, out_dir)
 
-        # Create the search space
-        possible_options = self.opt_spec.search_template.generate_search_space_dataframe()
-        search_x = possible_options[self.opt_spec.search_template.input_columns]
-        self.logger.info(f'Created {len(search_x)} samples to be evaluated')
-
-        # Send it to be evaluated remotely
-        chunk_size = self.opt_spec.planner_options.get('chunk_size')
-        chunk_start = 0
-        n_chunks = 0
-        for i, chunk in enumerate(np.array_split(search_x, len(search_x) // chunk_size)):
-            self.queues.send_inputs(model, chunk,
-                                    method='run_inference', topic='compute',  # Define what to run
-                                    task_info={'chunk_start': chunk_start},  # Maintain how to map to search space
-                                    keep_inputs=False)  # Optimization: Do not send search space or model back
-            chunk_start += len(chunk)
-            n_chunks += 1
-        self.logger.info(f'Sent all {n_chunks} inference tasks')
-
-        # Prepare to be able to store the data
-        search_y = np.empty((len(search_x),))
-        search_std = np.empty((len(search_y),))
-        for i in range(n_chunks):
-            result = self.queues.get_result(topic='compute')  # Get the result
-            if not result.success:
-                raise ValueError(f'Inference task failed.\n{result.task_info["exception"]}')
-
-            # Store the result
-            chunk_start = result.task_info['chunk_start']
-            chunk_y, chunk_std = result.value
-            search_y[chunk_start:(chunk_start + len(chunk_y))] = chunk_y
-            search_std[chunk_start:(chunk_start + len(chunk_y))] = chunk_std
-            self.logger.info(f'Recorded inference task {i + 1}/{n_chunks}. Starting point: {chunk_start}')
-
-        # Get the largest UCB
+        # Compile the model once so that the inference tasks need not repeat the same linear algebra
+        #  The model is always fit in double precision, but inference may use lower precision
+        predictor = compile_predictor(model)
+        inference_dtype = self.opt_spec.planner_options.get('inference_dtype')
+        if inference_dtype is not None:
+            predictor = predictor.astype(inference_dtype)
+
+        # Create a view of the search space, which generates points only as they are needed
+        template = self.opt_spec.search_template
+        search_space = template.get_search_space(inference_dtype)
+        self.logger.info(f'Created a search space of {len(search_space)} samples to be evaluated')
+
+        # Determine how many candidates we need from each chunk
         assert self.opt_spec.maximize, "The optimization requests minimization"
-        ei = EI(search_y, search_std, max_val=np.max(train_y), tradeoff=0.1)
-        best_ind = np.argmax(ei)
-        best_point = search_x.iloc[best_ind][self.opt_spec.search_template.input_columns]
+        max_val = np.max(train_y)
+        tradeoff = 0.1
+        batch_size = self.opt_spec.planner_options.get('batch_size', 1)
+        top_k = 1 if batch_size == 1 else self.opt_spec.planner_options.get('batch_pool_size', 1000)
+
+        # Never select points which were already measured or are known to fail,
+        #  and, if desired, compute the uncertainty only for points that could have the largest EI
+        options = self.opt_spec.planner_options
+        exclude = np.zeros((0,), dtype=np.int64)
+        if options.get('exclude_measured', True):
+            exclude = search_space.get_indices(np.concatenate([train_x, failed_x]))
+            exclude = np.unique(exclude[exclude >= 0])
+            self.logger.info(f'Excluding {len(exclude)} measured points from the search')
+        screen = options.get('prescreen', False)
+
+        # Send it to be evaluated remotely. Each task returns only the points with the largest EI
+        #  The "range" transport sends only the template and the indices of each chunk,
+        #  and the "array" transport sends the points in each chunk
+        #  and the "shared" transport sends the paths of files holding the model and search space
+        chunk_size = self._get_chunk_size(len(search_space), len(search_space.columns), len(train_x),
+                                          predictor.dtype.itemsize)
+        self.logger.info(f'Evaluating the search space in chunks of {chunk_size} points')
+        transport = self.opt_spec.planner_options.get('inference_transport', 'range')
+        if transport == 'shared':
+            model_path, search_path = self._write_shared_inputs(predictor, search_space, chunk_size)
+
+        # Always remove the model file, even if a task fails
+        try:
+            n_chunks = 0
+            for chunk_start in range(0, len(search_space), chunk_size):
+                task_info = {'chunk_start': chunk_start}  # Maintain how to map to search space
+                chunk_exclude = exclude[(exclude >= chunk_start) & (exclude < chunk_start + chunk_size)] - chunk_start
+                if transport == 'range':
+                    self.queues.send_inputs(predictor, template, chunk_start, chunk_size, max_val, tradeoff, top_k,
+                                            chunk_exclude, screen,
+                                            method='run_acquisition_on_range', topic='compute',
+                                            task_info=task_info, keep_inputs=False)
+                elif transport == 'array':
+                    self.queues.send_inputs(predictor, search_space.get_chunk(chunk_start, chunk_size),
+                                            max_val, tradeoff, top_k,
+                                            chunk_exclude, screen,
+                                            method='run_acquisition', topic='compute',  # Define what to run
+                                            task_info=task_info,
+                                            keep_inputs=False)  # Optimization: Do not send search space or model back
+                elif transport == 'shared':
+                    self.queues.send_inputs(str(model_path), str(search_path), chunk_start, chunk_size,
+                                            max_val, tradeoff, top_k,
+                                            chunk_exclude, screen,
+                                            method='run_acquisition_on_shared', topic='compute',
+                                            task_info=task_info, keep_inputs=False)
+                else:
+                    raise ValueError(f'Unrecognized inference transport: {transport}')
+                n_chunks += 1
+            self.logger.info(f'Sent all {n_chunks} inference tasks')
+
+            # Merge the best points from each chunk as they arrive, keeping the top k in a min-heap
+            #  and measure the time spent per point so we can size the chunks for the next iteration
+            best_points: List[Tuple[float, int]] = []
+            total_time = total_rows = 0
+            for i in range(n_chunks):
+                result = self.queues.get_result(topic='compute')  # Get the result
+                if not result.success:
+                    raise ValueError(f'Inference task failed.\n{result.task_info["exception"]}')
+
+                # Store the result
+                chunk_start = result.task_info['chunk_start']
+                if result.time_running is not None:
+                    total_time += result.time_running
+                    total_rows += min(chunk_size, len(search_space) - chunk_start)
+                merge_best_points(best_points, chunk_start, *result.value, top_k)
+                self.logger.info(f'Recorded inference task {i + 1}/{n_chunks}. Starting point: {chunk_start}')
+        finally:
+            if transport == 'shared':
+                model_path.unlink(missing_ok=True)
+        if total_rows > 0:
+            self.inference_row_cost = total_time / total_rows
+            self.logger.info(f'Inference required {self.inference_row_cost * 1e6:.2f} us per point')
+
+        # Get the largest EI
+        if len(best_points) == 0:
+            raise ValueError('Every point in the search space has already been measured')
+        best_points.sort(reverse=True)
+        if batch_size == 1:
+            best_inds = [best_points[0][1]]
+        else:
+            # Select the batch from among the points with the largest EI
+            pool = np.array([ind for _, ind in best_points])
+            strategy = self.opt_spec.planner_options.get('batch_strategy', 'kriging_believer')
+            chosen = select_batch(model, search_space[pool], batch_size, max_val, tradeoff=tradeoff, strategy=strategy)
+            best_inds = [int(pool[i]) for i in chosen]
+            self.logger.info(f'Selected a batch of {len(best_inds)} samples using {strategy}')
+
+        # Make the samples and send them out
+        outputs = []
+        for i, best_ind in enumerate(best_inds):
+            output = self.opt_spec.search_template.create_new_sample()
+            output.inputs.update(search_space.get_inputs(best_ind))
+            outputs.append(output)
+
+            name = 'selected_sample.json' if len(best_inds) == 1 else f'selected_sample-{i}.json'
+            with out_dir.joinpath(name).open('w') as fp:
+                print(output.json(indent=2), file=fp)
+
+        if len(outputs) == 1:
+            self.logger.info('Sending a new sample to the robot')
+            send_new_sample(outputs[0])
+        else:
+            self.logger.info(f'Sending {len(outputs)} new samples to the robot')
+            send_new_samples(outputs)
+
+        # Save the state of the planner, then assess the model now that the robot is busy
+        self._save_checkpoint()
+        self._submit_cross_validation(model, train_x, train_y, out_dir)
+
+    def _get_chunk_size(self, n_points: int, n_columns: int, n_train: int, itemsize: int = 8) -> int:
+        """Determine the number of points to evaluate in each inference task
+
+        Uses ``chunk_size`` from the planner options, if set.
+        Otherwise, sizes the chunks based on the number of workers, the cost of inference
+        from the previous iteration, and a memory budget of ``chunk_memory_limit`` MB per task.
+
+        Args:
+            n_points: Number of points in the search space
+            n_columns: Number of inputs for each point
+            n_train: Number of points in the training set
+            itemsize: Number of bytes per value used during inference
+        Returns:
+            Number of points per chunk
+        """
+        options = self.opt_spec.planner_options
+        if options.get('chunk_size') is not None:
+            return options['chunk_size']
+
+        # Predicting the mean and standard deviation stores two arrays of kernel values
+        #  between the chunk and the training set, in addition to the points themselves
+        bytes_per_row = itemsize * (n_columns + 2 * n_train + 2)
+        n_workers = settings.task_workers or os.cpu_count() or 1
+        return choose_chunk_size(n_points, n_workers, bytes_per_row,
+                                 memory_budget=options.get('chunk_memory_limit', 512) * 1024 ** 2,
+                                 row_cost=self.inference_row_cost,
+                                 max_task_time=options.get('max_task_time', 30),
+                                 chunks_per_worker=options.get('chunks_per_worker', 4),
+                                 min_chunk_size=options.get('min_chunk_size', 1000))
+
+    def _write_shared_inputs(self, model: Predictor, search_space: SearchSpace, chunk_size: int) -> Tuple[Path, Path]:
+        """Write the model and search space to files that can be read by workers on this node
+
+        The files are placed in :attr:`shared_dir`, which is removed when the planner exits.
+        The search space is written only once for each search template.
+
+        Args:
+            model: Model to be written
+            search_space: Search space to be written
+            chunk_size: Number of points to generate at a time when writing the search space
+        Returns:
+            - Path to the model
+            - Path to the search space
+        """
+        shared_dir = self.shared_dir
+        shared_dir.mkdir(parents=True, exist_ok=True)
+
+        # Write the model. Each iteration uses a new file so that workers can cache models by path
+        model_path = shared_dir / f'model-{self.iteration}.pkl'
+        temp_path = model_path.with_suffix('.tmp')
+        with temp_path.open('wb') as fp:
+            pkl.dump(model, fp)
+        os.replace(temp_path, model_path)
+
+        # Write the search space in chunks, if it is not already present
+        template_hash = sha256(self.opt_spec.search_template.json().encode()).hexdigest()[:16]
+        search_path = shared_dir / f'search-space-{template_hash}-{search_space.dtype.name}.npy'
+        if not search_path.is_file():
+            temp_path = shared_dir / 'search-space.tmp'
+            search_x = np.lib.format.open_memmap(temp_path, mode='w+', dtype=search_space.dtype,
+                                                 shape=(len(search_space), len(search_space.columns)))
+            for start, chunk in search_space.iter_chunks(chunk_size):
+                search_x[start:start + len(chunk)] = chunk
+            search_x.flush()
+            del search_x
+            os.replace(temp_path, search_path)
+            self.logger.info(f'Wrote the search space to {search_path}')
+
+        # Remove search spaces from previous templates. Workers which have them open can still read them
+        for path in shared_dir.glob('search-space-*.npy'):
+            if path != search_path:
+                path.unlink(missing_ok=True)
+                self.logger.info(f'Removed an outdated search space: {path}')
+        return model_path, search_path
+
+    @property
+    def shared_dir(self) -> Path:
+        """Directory holding the files shared with workers on this node
+
+        Set using ``shared_dir`` in the planner options. Defaults to a directory in ``/dev/shm``
+        so that the files are held in memory.
+        """
+        default_dir = Path('/dev/shm') if Path('/dev/shm').is_dir() else self.output_dir
+        return Path(self.opt_spec.planner_options.get('shared_dir', default_dir)) / f'polybot-{self.output_dir.name}'
 
-        # Make the sample and send it out
-        output = self.opt_spec.search_template.create_new_sample()
-        for p, x in zip(self.opt_spec.search_template.input_columns, best_point):
-            output.inputs[p] = x
+    def _remove_shared_dir(self):
+        """Remove the files shared with workers, which would otherwise occupy memory after the planner exits"""
+        if self.shared_dir.is_dir():
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
 
-        with out_dir.joinpath('selected_sample.json').open('w') as fp:
-            print(output.json(indent=2), file=fp)
-        self.logger.info('Sending a new sample to the robot')
-        send_new_sample(output)
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self._remove_shared_dir()
 
     def _fit_model(self, train_x: np.ndarray, train_y: np.ndarray, out_dir: Path) -> Pipeline:
-        """Fit and test a model using the latest data
+        """Fit a model using the latest data
 
         Args:
             train_x: Input columns
@@ -160,6 +748,14 @@ class BOPlanner(BasePlanner):
         scale_factor = (train_y.max() - train_y.min())
         train_y = (train_y - train_y.min()) / scale_factor
 
+        # Update the previous model with only the new points, if possible
+        model = self._update_model(train_x, train_y)
+        if model is not None:
+            self.model_train_x = train_x
+            self.model_writer.submit(model, train_x, out_dir, self.iteration)
+            self.model_path = out_dir / 'model.npz'
+            return model
+
         # Create an initial RBF kernel, using the training set mean as a scaling parameter
         kernel = train_y.mean() ** 2 * kernels.RBF(length_scale=1)
 
@@ -184,64 +780,174 @@ class BOPlanner(BasePlanner):
         elif noise > 0:
             kernel = kernel + kernels.WhiteKernel(noise ** 2, noise_level_bounds=(noise ** 2,) * 2)
 
+        # Start from the hyperparameters of the previous model when updating incrementally
+        if self.model is not None and self.opt_spec.planner_options.get('refit_interval', 1) > 1:
+            kernel = self.model['gpr'].kernel_
+
         # Train a GPR model
         self.logger.debug('Starting kernel')
         model = Pipeline([
             ('variance', VarianceThreshold()),
             ('scale', StandardScaler()),
-            ('gpr', GaussianProcessRegressor(kernel))
+            ('gpr', make_surrogate(kernel, self.opt_spec.planner_options))
         ])
 
-        # Perform k-Fold cross-validation to estimate model performance
-        if len(train_x) > 5:
-            cv_results = cross_validate(model, train_x, train_y, cv=RepeatedKFold(), return_train_score=True,
-                                        scoring='neg_mean_squared_error')
-            with out_dir.joinpath('cross-val-results.pkl').open('wb') as fp:
-                pkl.dump(cv_results, fp)
-
-            # Get the RMSE in the unscaled units
-            rmse = np.sqrt(-1 * np.mean(cv_results["test_score"]))
-            rmse *= scale_factor
-
-            # Print out to screen
-            self.logger.info(f'Performed cross-validation. RMSE: {rmse:.2e}')
-        else:
-            self.logger.info('Insufficient data for cross-validation')
-
         # Train and save the model
         model.fit(train_x, train_y)
         self.logger.info(f'Finished fitting the model on {len(train_x)} data points')
         self.logger.info(f'Optimized model: {model["gpr"].kernel_}')
-        with out_dir.joinpath('model.pkl').open('wb') as fp:
-            pkl.dump(model, fp)
+        self.model_writer.submit(model, train_x, out_dir, self.iteration)
+
+        # Store the model so that we can update it later
+        self.model = model
+        self.model_train_x = train_x
+        self.model_path = out_dir / 'model.npz'
+        self.n_since_refit = 0
+        self.refit_lml = model['gpr'].log_marginal_likelihood_value_ / len(train_x)
+        return model
+
+    def _submit_cross_validation(self, model: Pipeline, train_x: np.ndarray, train_y: np.ndarray,
+                                 out_dir: Path) -> Optional[Future]:
+        """Start cross-validation of a model in the background
+
+        Runs every ``cv_frequency`` iterations, and never if ``cv_frequency`` is 0.
+
+        Args:
+            model: Model to be tested. Will not be modified
+            train_x: Input columns
+            train_y: Output column
+            out_dir: Location to store the results
+        Returns:
+            Future for the cross-validation results, if it was started
+        """
+        options = self.opt_spec.planner_options
+        frequency = options.get('cv_frequency', 1)
+        if frequency <= 0 or self.iteration % frequency != 0:
+            return None
+        if len(train_x) <= 5:
+            self.logger.info('Insufficient data for cross-validation')
+            return None
+
+        # Copy the settings of the model, but not the fitted parameters
+        model = clone(model)
+        cv = RepeatedKFold(n_splits=options.get('cv_folds', 5), n_repeats=options.get('cv_repeats', 10))
+        future = self.cv_executor.submit(self._cross_validate, model, train_x, train_y, cv,
+                                         options.get('cv_n_jobs'), out_dir)
+        future.add_done_callback(self._log_cross_validation_failure)
+
+        # Keep the iteration directory until the results are written
+        self.model_writer.hold(out_dir, future)
+        return future
+
+    def _cross_validate(self, model: Pipeline, train_x: np.ndarray, train_y: np.ndarray, cv: RepeatedKFold,
+                        n_jobs: Optional[int], out_dir: Path) -> dict:
+        """Perform k-Fold cross-validation to estimate model performance
+
+        Args:
+            model: Model to be tested
+            train_x: Input columns
+            train_y: Output column
+            cv: Cross-validation splitter
+            n_jobs: Number of folds to evaluate in parallel
+            out_dir: Location to store the results
+        Returns:
+            Cross-validation results
+        """
+        # Min-max scaling, as in `_fit_model`
+        scale_factor = (train_y.max() - train_y.min())
+        train_y = (train_y - train_y.min()) / scale_factor
+
+        cv_results = cross_validate(model, train_x, train_y, cv=cv, return_train_score=True,
+                                    scoring='neg_mean_squared_error', n_jobs=n_jobs)
+        np.savez(out_dir / 'cross-val-results.npz', **cv_results)
+
+        # Get the RMSE in the unscaled units
+        rmse = np.sqrt(-1 * np.mean(cv_results["test_score"]))
+        rmse *= scale_factor
+
+        # Print out to screen
+        self.logger.info(f'Performed cross-validation for {out_dir.name}. RMSE: {rmse:.2e}')
+        return cv_results
+
+    def _log_cross_validation_failure(self, future: Future):
+        """Report if cross-validation failed
+
+        Args:
+            future: Future for the cross-validation
+        """
+        if future.exception() is not None:
+            self.logger.warning(f'Cross-validation failed: {future.exception()}')
+
+    def _update_model(self, train_x: np.ndarray, train_y: np.ndarray) -> Optional[Pipeline]:
+        """Add new points to the previous model while holding its hyperparameters fixed
+
+        Only possible for an exact GPR, and if the training set of the previous model is the start of the new training set.
+        The hyperparameters should be re-optimized every ``refit_interval`` new points,
+        or when the log-marginal likelihood per point changes by more than ``lml_drift_tolerance``.
+
+        Args:
+            train_x: Input columns
+            train_y: Output column, scaled
+        Returns:
+            The updated model, or ``None`` if the model must be fit from scratch
+        """
+        # Determine if we can perform an update
+        refit_interval = self.opt_spec.planner_options.get('refit_interval', 1)
+        if self.model is None or refit_interval <= 1 or not isinstance(self.model['gpr'], GaussianProcessRegressor):
+            return None
+        n_old = len(self.model_train_x)
+        if len(train_x) < n_old or not np.array_equal(train_x[:n_old], self.model_train_x):
+            self.logger.info('Training set has changed since the last fit. Fitting the model from scratch')
+            return None
+        n_new = len(train_x) - n_old
+        if self.n_since_refit + n_new >= refit_interval:
+            self.logger.info(f'Added {self.n_since_refit + n_new} points since the last fit. Fitting the model from scratch')
+            return None
+
+        # Add the new points, using the preprocessing steps from the previous fit
+        model = self.model
+        new_x = model[:-1].transform(train_x[n_old:])
+        try:
+            add_training_points(model['gpr'], new_x, train_y)
+        except np.linalg.LinAlgError:
+            self.logger.info('Kernel matrix is no longer positive definite. Fitting the model from scratch')
+            return None
+        self.n_since_refit += n_new
+
+        # Check whether the hyperparameters still describe the data well
+        lml = model['gpr'].log_marginal_likelihood_value_ / len(train_x)
+        tolerance = self.opt_spec.planner_options.get('lml_drift_tolerance', 0.25)
+        if abs(lml - self.refit_lml) > tolerance:
+            self.logger.info(f'Log-marginal likelihood per point changed from {self.refit_lml:.3f} to {lml:.3f}.'
+                             ' Fitting the model from scratch')
+            return None
+        self.logger.info(f'Added {n_new} points to the model without re-optimizing. Total: {len(train_x)}')
         return model
 
     def generate_training_set(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-        """Load in all of the previous samples to build a training set
+        """Gather all of the previous samples to build a training set
 
-        Uses the inputs and outputs defined in the optimization specification
+        Uses the inputs and outputs defined in the optimization specification.
+        Reads only the samples added to the local store since the last call.
 
         Returns:
             - Input features for training set
             - Output variable for training set
             - Input features for failed samples
         """
+        n_new = self.training_set.update()
+        self.logger.info(f'Added {n_new} new samples to the training set')
+        return self.training_set.get_arrays()
 
-        # Get the name of the input columns
-        input_columns = self.opt_spec.search_template.input_columns
-
-        train_x = []
-        train_y = []
-        failed_x = []
-        # Loop over samples in the training data
-        for sample in load_samples():
-            if sample.processed_output['sample_quality']['defective'] \
-                    and sample.raw_output['thickness_data']['goodness of fitting'] > 0.9 \
-                    and self.opt_spec.output in sample.processed_output:
-                failed_x.append([sample.inputs[i] for i in input_columns])  # Store coordinates of bad samples
-            else:
-                train_x.append([sample.inputs[i] for i in input_columns])  # Get only the needed input columns
-                train_y.append(sample.processed_output[self.opt_spec.output])  # Get the target output column
-
-        # Convert them to numpy and return
-        return np.array(train_x), np.array(train_y), np.array(failed_x)
+    def _find_failed(self, samples: SampleCollection) -> np.ndarray:
+        """Determine which samples are failed measurements
+
+        Args:
+            samples: Samples to evaluate
+        Returns:
+            Whether each sample failed
+        """
+        defective = samples.get_column('processed_output.sample_quality.defective', dtype=float) == 1
+        good_fit = samples.get_column('raw_output.thickness_data.goodness of fitting', dtype=float) > 0.9
+        has_output = ~np.isnan(samples.get_column(f'processed_output.{self.opt_spec.output}', dtype=float))
+        return defective & good_fit & has_output
@@ -0,0 +1,465 @@
+"""Utilities for the surrogate models used by the Bayesian optimization planner
+
+The planner works with any surrogate that follows the interface of scikit-learn's :class:`GaussianProcessRegressor`:
+``fit(X, y)``, ``predict(X, return_std=True)`` returning the mean and standard deviation,
+and the fitted ``kernel_``, ``X_train_`` and ``y_train_`` attributes.
+Surrogates are created by :meth:`make_surrogate` given the ``surrogate`` option of the planner.
+"""
+from threading import local
+from typing import Optional, Union, Tuple, List
+import copy
+
+import numpy as np
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.gaussian_process import GaussianProcessRegressor, kernels
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+
+def add_training_points(gpr: GaussianProcessRegressor, new_x: np.ndarray, train_y: np.ndarray) -> GaussianProcessRegressor:
+    """Add points to the training set of a fitted GPR without re-optimizing its hyperparameters
+
+    Extends the Cholesky factor of the kernel matrix with a block for the new points,
+    which costs O(n^2) per new point rather than the O(n^3) of factorizing the full matrix again.
+
+    Args:
+        gpr: Fitted model, which is updated in place. Must have been fit with ``normalize_y=False``
+        new_x: Inputs for the new points, in the same feature space as the existing training set
+        train_y: Outputs for the full training set: the existing points followed by the new points.
+            The outputs of the existing points may differ from those used previously (e.g., if they were rescaled)
+    Returns:
+        The updated model
+    """
+    old_x = gpr.X_train_
+    if len(train_y) != len(old_x) + len(new_x):
+        raise ValueError(f'Expected {len(old_x) + len(new_x)} outputs, received {len(train_y)}')
+
+    # Compute the new blocks of the Cholesky factor:
+    #  [[L, 0], [B^T, C]], where L B = K(old, new) and C C^T = K(new, new) - B^T B
+    if len(new_x) > 0:
+        k_cross = gpr.kernel_(old_x, new_x)
+        k_new = gpr.kernel_(new_x)
+        k_new[np.diag_indices_from(k_new)] += gpr.alpha
+        b = solve_triangular(gpr.L_, k_cross, lower=True, check_finite=False)
+        c = cholesky(k_new - b.T @ b, lower=True, check_finite=False)
+
+        n_old, n_new = len(old_x), len(new_x)
+        l_matrix = np.zeros((n_old + n_new,) * 2)
+        l_matrix[:n_old, :n_old] = gpr.L_
+        l_matrix[n_old:, :n_old] = b.T
+        l_matrix[n_old:, n_old:] = c
+        gpr.L_ = l_matrix
+        gpr.X_train_ = np.vstack([old_x, new_x])
+
+    # Update the weights for all points, as the outputs of the existing points may have changed
+    gpr.y_train_ = np.array(train_y, dtype=float)
+    gpr.alpha_ = cho_solve((gpr.L_, True), gpr.y_train_, check_finite=False)
+    gpr.log_marginal_likelihood_value_ = log_marginal_likelihood(gpr)
+    return gpr
+
+
+def log_marginal_likelihood(gpr: GaussianProcessRegressor) -> float:
+    """Compute the log-marginal likelihood of the training data for a fitted GPR
+
+    Uses the Cholesky factor stored in the model rather than factorizing the kernel matrix again.
+
+    Args:
+        gpr: Fitted model
+    Returns:
+        Log-marginal likelihood
+    """
+    return float(-0.5 * np.dot(gpr.y_train_, gpr.alpha_)
+                 - np.log(np.diag(gpr.L_)).sum()
+                 - len(gpr.y_train_) / 2 * np.log(2 * np.pi))
+
+
+def make_surrogate(kernel: kernels.Kernel, options: dict) -> Union[GaussianProcessRegressor, 'SparseGPR']:
+    """Create an unfitted surrogate model
+
+    Args:
+        kernel: Initial kernel for the model
+        options: Options for the planner. Uses ``surrogate``, which is either "exact" (the default) or "sparse",
+            and ``n_inducing`` which sets the number of inducing points for the sparse model
+    Returns:
+        The surrogate model
+    """
+    surrogate = options.get('surrogate', 'exact')
+    if surrogate == 'exact':
+        return GaussianProcessRegressor(kernel)
+    elif surrogate == 'sparse':
+        return SparseGPR(kernel, n_inducing=options.get('n_inducing', 500))
+    else:
+        raise ValueError(f'Unrecognized surrogate: {surrogate}')
+
+
+def _split_noise(kernel: kernels.Kernel) -> Tuple[kernels.Kernel, float]:
+    """Separate a white noise term from the rest of a kernel
+
+    Args:
+        kernel: Kernel, which may be the sum of a kernel and a :class:`~sklearn.gaussian_process.kernels.WhiteKernel`
+    Returns:
+        - Kernel without the noise term
+        - Variance of the noise
+    """
+    if isinstance(kernel, kernels.Sum) and isinstance(kernel.k2, kernels.WhiteKernel):
+        return kernel.k1, kernel.k2.noise_level
+    return kernel, 0.
+
+
+class SparseGPR(BaseEstimator, RegressorMixin):
+    """Gaussian process regression that approximates the full training set using a subset of inducing points
+
+    Uses the Deterministic Training Conditional (DTC) approximation, which
+    costs O(nm^2) to fit and O(m^2) per prediction for m inducing points, rather than
+    O(n^3) and O(n^2) for an exact GPR on n training points.
+    The hyperparameters of the kernel are optimized with an exact GPR fit to only the inducing points.
+    """
+
+    def __init__(self, kernel: Optional[kernels.Kernel] = None, n_inducing: int = 500, alpha: float = 1e-10,
+                 optimizer: Optional[str] = 'fmin_l_bfgs_b', min_noise: float = 1e-6,
+                 random_state: Optional[int] = None):
+        """
+        Args:
+            kernel: Kernel for the model. Its hyperparameters are optimized during fitting unless ``optimizer`` is ``None``
+            n_inducing: Maximum number of inducing points, which are chosen at random from the training set
+            alpha: Value added to the diagonal of the kernel matrix during fitting
+            optimizer: Optimizer for the kernel hyperparameters. See :class:`GaussianProcessRegressor`
+            min_noise: Smallest noise variance to use in the approximation, which keeps the matrices well-conditioned
+            random_state: Seed for selecting the inducing points
+        """
+        self.kernel = kernel
+        self.n_inducing = n_inducing
+        self.alpha = alpha
+        self.optimizer = optimizer
+        self.min_noise = min_noise
+        self.random_state = random_state
+
+    def fit(self, X: np.ndarray, y: np.ndarray) -> 'SparseGPR':
+        """Fit the model
+
+        Args:
+            X: Training inputs
+            y: Training outputs
+        Returns:
+            self
+        """
+        self.X_train_ = np.asarray(X, dtype=float)
+        self.y_train_ = np.asarray(y, dtype=float)
+
+        # Optimize the hyperparameters using only the inducing points
+        rng = np.random.default_rng(self.random_state)
+        n_inducing = min(self.n_inducing, len(X))
+        inds = np.sort(rng.choice(len(X), size=n_inducing, replace=False))
+        self.inducing_x_ = self.X_train_[inds]
+        gpr = GaussianProcessRegressor(self.kernel, alpha=self.alpha, optimizer=self.optimizer)
+        gpr.fit(self.inducing_x_, self.y_train_[inds])
+        self.kernel_ = gpr.kernel_
+        self.log_marginal_likelihood_value_ = gpr.log_marginal_likelihood_value_
+
+        # Compute the factors used for prediction:
+        #  L_m L_m^T = K_mm, A = L_m^-1 K_mn / s, L_B L_B^T = I + A A^T
+        signal, noise = _split_noise(self.kernel_)
+        noise = max(noise + self.alpha, self.min_noise)
+        k_mm = signal(self.inducing_x_)
+        k_mm[np.diag_indices_from(k_mm)] += self.alpha
+        l_m = cholesky(k_mm, lower=True, check_finite=False)
+        a = solve_triangular(l_m, signal(self.inducing_x_, self.X_train_), lower=True, check_finite=False)
+        a /= np.sqrt(noise)
+        b = a @ a.T
+        b[np.diag_indices_from(b)] += 1
+        l_b = cholesky(b, lower=True, check_finite=False)
+
+        # Store the matrices needed to make predictions from the kernel between new points and the inducing points
+        #  The mean is K_*m w, and the variance is k_** - |L_m^-1 K_m*|^2 + |(L_m L_B)^-1 K_m*|^2
+        c = solve_triangular(l_b, a @ self.y_train_, lower=True, check_finite=False) / np.sqrt(noise)
+        self.weights_ = solve_triangular(l_m, solve_triangular(l_b, c, lower=True, trans='T', check_finite=False),
+                                         lower=True, trans='T', check_finite=False)
+        self.inv_l_m_ = solve_triangular(l_m, np.eye(n_inducing), lower=True, check_finite=False)
+        self.inv_l_mb_ = solve_triangular(l_b, self.inv_l_m_, lower=True, check_finite=False)
+        self.signal_kernel_ = signal
+        return self
+
+    def predict(self, X: np.ndarray, return_std: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """Predict the mean and, optionally, the standard deviation
+
+        Args:
+            X: Points to evaluate
+            return_std: Whether to return the standard deviation
+        Returns:
+            - Mean of the predictions
+            - Standard deviation of the predictions, if ``return_std``
+        """
+        k_trans = self.signal_kernel_(X, self.inducing_x_)
+        y_mean = k_trans @ self.weights_
+        if not return_std:
+            return y_mean
+
+        y_var = self.kernel_.diag(X)
+        y_var -= np.square(k_trans @ self.inv_l_m_.T).sum(axis=1)
+        y_var += np.square(k_trans @ self.inv_l_mb_.T).sum(axis=1)
+        return y_mean, np.sqrt(np.clip(y_var, 0, None))
+
+
+class Predictor:
+    """Model compiled for making many predictions quickly
+
+    Holds everything needed to predict the mean and standard deviation with matrix multiplications alone:
+    the preprocessing steps fused into a single column selection and affine transform, the points
+    used to compute kernel values, the weights for the mean, and pre-inverted factors for the variance.
+    The variance is the prior variance minus (or plus) the squared norm of each factor applied to the kernel values.
+
+    Kernel values for an RBF kernel, optionally multiplied by a constant, are computed from
+    matrix products with basis points which are pre-divided by the length scale,
+    and in the data type of the predictor. Other kernels are computed by scikit-learn.
+
+    Create using :meth:`compile_predictor`. Use :meth:`astype` to make predictions with reduced precision.
+    """
+
+    def __init__(self, columns: Optional[np.ndarray], shift: np.ndarray, scale: np.ndarray,
+                 basis_x: np.ndarray, kernel: kernels.Kernel, prior_kernel: kernels.Kernel,
+                 weights: np.ndarray, factors: List[Tuple[float, np.ndarray]],
+                 y_mean: float = 0., y_std: float = 1., block_size: int = 1024):
+        """
+        Args:
+            columns: Columns of the inputs used by the model, or ``None`` to use all
+            shift: Value subtracted from each used column
+            scale: Value by which to divide each used column after shifting
+            basis_x: Points, in the scaled feature space, for which we compute the kernel with each new point
+            kernel: Kernel used to compute values between new points and the basis points
+            prior_kernel: Kernel used to compute the prior variance of new points
+            weights: Weight of each basis point for the mean
+            factors: Sign and matrix for each term of the variance
+            y_mean: Offset of the predicted mean
+            y_std: Scale of the predicted mean and standard deviation
+            block_size: Number of points to predict at a time
+        """
+        self.columns = columns
+        self.shift = shift
+        self.inv_scale = 1. / scale
+        self.basis_x = basis_x
+        self.kernel = kernel
+        self.prior_kernel = prior_kernel
+        self.weights = weights
+        self.factors = factors
+        self.y_mean = y_mean
+        self.y_std = y_std
+        self.block_size = block_size
+        self.dtype = np.dtype(np.float64)
+        self._work = local()  # Work space for each thread
+
+        # Store the basis points in the form needed to compute RBF kernels quickly, if possible
+        self.amplitude, self.length_scale = _get_rbf_parameters(kernel)
+        self.basis_norm: Optional[np.ndarray] = None
+        if self.length_scale is not None:
+            self.basis_x = basis_x / self.length_scale
+            self.basis_norm = np.square(self.basis_x).sum(axis=1)
+
+    def astype(self, dtype: Union[str, np.dtype]) -> 'Predictor':
+        """Make a copy of the predictor which computes in a different precision
+
+        Args:
+            dtype: Data type to use for the points and all arrays derived from them
+        Returns:
+            Copy of this predictor
+        """
+        output = copy.copy(self)
+        output.dtype = np.dtype(dtype)
+        output._work = local()
+        for name in ['shift', 'inv_scale', 'basis_x', 'weights', 'basis_norm', 'length_scale', 'amplitude']:
+            if getattr(self, name) is not None:
+                setattr(output, name, np.asarray(getattr(self, name), dtype=output.dtype))
+        output.factors = [(sign, factor.astype(output.dtype)) for sign, factor in self.factors]
+        return output
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_work']  # Do not send the work space
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._work = local()
+
+    def transform(self, X: np.ndarray) -> np.ndarray:
+        """Apply the preprocessing steps
+
+        Args:
+            X: Points in the original feature space
+        Returns:
+            Points in the feature space of the model
+        """
+        features = np.array(X, dtype=self.dtype) if self.columns is None else np.asarray(X, dtype=self.dtype)[:, self.columns]
+        features -= self.shift
+        features *= self.inv_scale
+        return features
+
+    def prior_std(self, features: np.ndarray) -> np.ndarray:
+        """Compute the standard deviation of the model before seeing any training data
+
+        Args:
+            features: Points in the feature space of the model
+        Returns:
+            Prior standard deviation, which is never smaller than the predicted standard deviation
+        """
+        return np.sqrt(self.prior_kernel.diag(features)).astype(self.dtype) * self.y_std
+
+    def _compute_kernel(self, block: np.ndarray) -> np.ndarray:
+        """Compute the kernel between a block of points and the basis points
+
+        Args:
+            block: Points in the feature space of the model
+        Returns:
+            Kernel values, where each row is a point from the block
+        """
+        if self.length_scale is None:
+            return self.kernel(block, self.basis_x).astype(self.dtype, copy=False)
+
+        # Compute exp(-|x - y|^2 / 2) using |x - y|^2 = |x|^2 + |y|^2 - 2 x . y
+        block = block / self.length_scale
+        output = block @ self.basis_x.T
+        output *= -2
+        output += np.square(block).sum(axis=1)[:, None]
+        output += self.basis_norm
+        np.clip(output, 0, None, out=output)
+        output *= -0.5
+        np.exp(output, out=output)
+        output *= self.amplitude
+        return output
+
+    def predict_features(self, features: np.ndarray, return_std: bool = False) \
+            -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """Predict the mean and, optionally, the standard deviation for points that were already transformed
+
+        Args:
+            features: Points in the feature space of the model
+            return_std: Whether to return the standard deviation
+        Returns:
+            - Mean of the predictions
+            - Standard deviation of the predictions, if ``return_std``
+        """
+        y_mean = np.empty((len(features),), dtype=self.dtype)
+        y_std = np.empty((len(features),), dtype=self.dtype) if return_std else None
+        for start in range(0, len(features), self.block_size):
+            block = features[start:start + self.block_size]
+            k_trans = self._compute_kernel(block)
+            np.dot(k_trans, self.weights, out=y_mean[start:start + len(block)])
+            if return_std:
+                y_std[start:start + len(block)] = self._compute_std(block, k_trans)
+
+        y_mean *= self.y_std
+        y_mean += self.y_mean
+        if return_std:
+            return y_mean, y_std
+        return y_mean
+
+    def _compute_std(self, block: np.ndarray, k_trans: np.ndarray) -> np.ndarray:
+        """Compute the standard deviation for a block of points, reusing the work space between calls
+
+        Args:
+            block: Points in the feature space of the model
+            k_trans: Kernel values between the points and the basis points
+        Returns:
+            Standard deviation for each point
+        """
+        buffer = getattr(self._work, 'buffer', None)
+        if buffer is None or len(buffer) < len(block):
+            buffer = self._work.buffer = np.empty((len(block), len(self.basis_x)), dtype=self.dtype)
+        buffer = buffer[:len(block)]
+
+        y_var = self.prior_kernel.diag(block).astype(self.dtype)
+        for sign, factor in self.factors:
+            np.dot(k_trans, factor.T, out=buffer)
+            np.square(buffer, out=buffer)
+            y_var += sign * buffer.sum(axis=1)
+        np.clip(y_var, 0, None, out=y_var)
+        return np.sqrt(y_var) * self.y_std
+
+    def predict(self, X: np.ndarray, return_std: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """Predict the mean and, optionally, the standard deviation
+
+        Args:
+            X: Points in the original feature space
+            return_std: Whether to return the standard deviation
+        Returns:
+            - Mean of the predictions
+            - Standard deviation of the predictions, if ``return_std``
+        """
+        return self.predict_features(self.transform(X), return_std=return_std)
+
+    def predict_mean_std(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict the mean and the standard deviation
+
+        Args:
+            X: Points in the original feature space
+        Returns:
+            - Mean of the predictions
+            - Standard deviation of the predictions
+        """
+        return self.predict(X, return_std=True)
+
+
+def _get_rbf_parameters(kernel: kernels.Kernel) -> Tuple[float, Optional[np.ndarray]]:
+    """Get the parameters of an RBF kernel, which may be multiplied by a constant
+
+    Args:
+        kernel: Kernel to evaluate
+    Returns:
+        - Amplitude of the kernel
+        - Length scale of the kernel, or ``None`` if the kernel is not an RBF kernel
+    """
+    amplitude = 1.
+    if isinstance(kernel, kernels.Product) and isinstance(kernel.k1, kernels.ConstantKernel):
+        amplitude, kernel = kernel.k1.constant_value, kernel.k2
+    if type(kernel) is kernels.RBF:  # Not subclasses, such as Matern
+        return amplitude, np.asarray(kernel.length_scale, dtype=float)
+    return 1., None
+
+
+def compile_predictor(model: Union[Pipeline, GaussianProcessRegressor, SparseGPR]) -> Predictor:
+    """Compile a fitted model into a form that is fast for repeated predictions
+
+    Inverting the triangular factors once here replaces the triangular solves made for each call to ``predict``.
+
+    Args:
+        model: Fitted model. Either a surrogate model or a pipeline of
+            :class:`VarianceThreshold` and :class:`StandardScaler` steps ending with a surrogate model
+    Returns:
+        Model compiled for prediction
+    """
+    # Fuse the preprocessing steps into a single transform
+    if isinstance(model, Pipeline):
+        steps, surrogate = model[:-1], model[-1]
+    else:
+        steps, surrogate = [], model
+    n_features = surrogate.X_train_.shape[1] if len(steps) == 0 else steps[0].n_features_in_
+    columns = np.arange(n_features)
+    shift = np.zeros((n_features,))
+    scale = np.ones((n_features,))
+    for step in steps:
+        if isinstance(step, VarianceThreshold):
+            support = step.get_support()
+            columns, shift, scale = columns[support], shift[support], scale[support]
+        elif isinstance(step, StandardScaler):
+            if step.mean_ is not None:
+                shift = shift + step.mean_ * scale
+            if step.scale_ is not None:
+                scale = scale * step.scale_
+        else:
+            raise ValueError(f'Unsupported preprocessing step: {step}')
+    if len(columns) == n_features:
+        columns = None
+
+    # Determine the factors for the surrogate model
+    if isinstance(surrogate, GaussianProcessRegressor):
+        inv_l = solve_triangular(surrogate.L_, np.eye(len(surrogate.L_)), lower=True, check_finite=False)
+        return Predictor(columns, shift, scale, surrogate.X_train_, _split_noise(surrogate.kernel_)[0], surrogate.kernel_,
+                         surrogate.alpha_, [(-1., inv_l)],
+                         y_mean=float(np.mean(getattr(surrogate, '_y_train_mean', 0.))),
+                         y_std=float(np.mean(getattr(surrogate, '_y_train_std', 1.))))
+    elif isinstance(surrogate, SparseGPR):
+        return Predictor(columns, shift, scale, surrogate.inducing_x_, surrogate.signal_kernel_, surrogate.kernel_,
+                         surrogate.weights_, [(-1., surrogate.inv_l_m_), (1., surrogate.inv_l_mb_)])
+    else:
+        raise ValueError(f'Unsupported surrogate: {surrogate}')
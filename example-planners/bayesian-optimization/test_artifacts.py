@@ -0,0 +1,99 @@
+from concurrent.futures import Future
+
+import numpy as np
+from pytest import fixture, raises
+from sklearn.gaussian_process import GaussianProcessRegressor, kernels
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from artifacts import ModelWriter, load_model_artifact
+
+
+@fixture()
+def data():
+    rng = np.random.default_rng(1)
+    train_x = rng.uniform(0, 10, size=(32, 2))
+    train_y = np.sin(train_x[:, 0]) + np.cos(train_x[:, 1])
+    return train_x, train_y
+
+
+def fit_model(train_x: np.ndarray, train_y: np.ndarray) -> Pipeline:
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=[1., 1.]) + kernels.WhiteKernel(1e-2)
+    return Pipeline([('scale', StandardScaler()), ('gpr', GaussianProcessRegressor(kernel))]).fit(train_x, train_y)
+
+
+def write_iteration(writer: ModelWriter, iteration: int, train_x: np.ndarray, train_y: np.ndarray) -> Pipeline:
+    out_dir = writer.run_dir / f'iteration-{iteration}'
+    out_dir.mkdir()
+    model = fit_model(train_x, train_y)
+    writer.submit(model, train_x, out_dir, iteration).result()
+    return model
+
+
+def test_round_trip(tmp_path, data):
+    train_x, train_y = data
+    writer = ModelWriter(tmp_path)
+    model = write_iteration(writer, 0, train_x, train_y)
+
+    # The copy is fit with the same hyperparameters, and does not re-optimize them
+    copy = load_model_artifact(tmp_path / 'iteration-0' / 'model.npz')
+    assert copy['gpr'].optimizer is None
+    assert str(copy['gpr'].kernel_) == str(model['gpr'].kernel_)
+    y_mean, y_std = model.predict(train_x, return_std=True)
+    copy_mean, copy_std = copy.predict(train_x, return_std=True)
+    assert np.allclose(copy_mean, y_mean)
+    assert np.allclose(copy_std, y_std)
+
+    with raises(ValueError):
+        ModelWriter(tmp_path, keep_iterations=0)
+
+
+def test_segments(tmp_path, data):
+    train_x, train_y = data
+    writer = ModelWriter(tmp_path)
+
+    # Each iteration writes only the new inputs
+    write_iteration(writer, 0, train_x[:16], train_y[:16])
+    write_iteration(writer, 1, train_x[:24], train_y[:24])
+    assert sorted(p.name for p in writer.data_dir.iterdir()) == ['inputs-0.npy', 'inputs-1.npy']
+    assert len(np.load(writer.data_dir / 'inputs-1.npy')) == 8
+    with np.load(tmp_path / 'iteration-1' / 'model.npz') as data:
+        assert data['segments'].tolist() == ['inputs-0.npy', 'inputs-1.npy']
+
+    # Start over when the earlier inputs change
+    write_iteration(writer, 2, train_x[::-1], train_y[::-1])
+    with np.load(tmp_path / 'iteration-2' / 'model.npz') as data:
+        assert data['segments'].tolist() == ['inputs-2.npy']
+    assert np.array_equal(np.load(writer.data_dir / 'inputs-2.npy'), train_x[::-1])
+
+    # Every iteration can still be loaded
+    for i, n in enumerate([16, 24, 32]):
+        assert len(load_model_artifact(tmp_path / f'iteration-{i}' / 'model.npz')['gpr'].X_train_) == n
+
+
+def test_retention(tmp_path, data):
+    train_x, train_y = data
+    writer = ModelWriter(tmp_path, keep_iterations=2)
+
+    # Keep a directory that another task is still writing to
+    write_iteration(writer, 0, train_x[:16], train_y[:16])
+    task = Future()
+    writer.hold(tmp_path / 'iteration-0', task)
+    write_iteration(writer, 1, train_x[:24], train_y[:24])
+    write_iteration(writer, 2, train_x[:28], train_y[:28])
+    assert (tmp_path / 'iteration-0').is_dir()
+
+    # It is removed once the task completes
+    task.set_result(None)
+    writer.executor.submit(lambda: None).result()  # Wait for the removal
+    assert sorted(p.name for p in tmp_path.glob('iteration-*')) == ['iteration-1', 'iteration-2']
+
+    # The inputs used only by the removed iterations are deleted, and the rest are kept
+    write_iteration(writer, 3, train_x, train_y)
+    assert sorted(p.name for p in tmp_path.glob('iteration-*')) == ['iteration-2', 'iteration-3']
+    assert sorted(p.name for p in writer.data_dir.iterdir()) == [f'inputs-{i}.npy' for i in range(4)]
+    write_iteration(writer, 4, train_x[::-1], train_y[::-1])
+    assert sorted(p.name for p in writer.data_dir.iterdir()) == [f'inputs-{i}.npy' for i in range(5)]
+    write_iteration(writer, 5, train_x[::-1], train_y[::-1])
+    assert sorted(p.name for p in writer.data_dir.iterdir()) == ['inputs-4.npy']
+    assert len(load_model_artifact(tmp_path / 'iteration-5' / 'model.npz')['gpr'].X_train_) == 32
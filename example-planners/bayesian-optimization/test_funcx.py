@@ -111,16 +111,15 @@ if __name__ == "__main__":
     model = fit_model(opt_spec, train_x, train_y)
 
     # Create the search space
-    possible_options = opt_spec.search_template.generate_search_space_dataframe()
-    search_x = possible_options[opt_spec.search_template.input_columns]
+    search_x = opt_spec.search_template.generate_search_space_array()
     print(f'Created {len(search_x)} samples to be evaluated')
 
     # Perform the inference
     # TODO (wardlt): This is the part that can be parallelized
-    chunk_size = opt_spec.planner_options.get('chunk_size')
+    chunk_size = opt_spec.planner_options.get('chunk_size') or 500000
     search_y = []
     search_std = []
-    for chunk in np.array_split(search_x, len(search_x) // chunk_size):
+    for chunk in np.array_split(search_x, max(len(search_x) // chunk_size, 1)):
         y_pred, y_std = run_inference(model, chunk)
         search_y.append(y_pred)
         search_std.append(y_std)
@@ -131,7 +130,7 @@ if __name__ == "__main__":
     assert opt_spec.maximize, "The optimization requests minimization"
     ei = EI(search_y, search_std, max_val=np.max(train_y), tradeoff=0.1)
     best_ind = np.argmax(ei)
-    best_point = search_x.iloc[best_ind][opt_spec.search_template.input_columns]
+    best_point = search_x[best_ind]
 
     # Make the sample and save it to disk
     output = opt_spec.search_template.create_new_sample()
@@ -0,0 +1,302 @@
+from pathlib import Path
+from typing import Tuple
+from threading import Thread
+from time import sleep
+
+import numpy as np
+import yaml
+from modAL.acquisition import EI
+from pytest import fixture, raises
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.gaussian_process import GaussianProcessRegressor, kernels
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from planner import BOPlanner, select_batch, run_acquisition, merge_best_points, run_acquisition_on_shared, \
+    choose_chunk_size, screen_candidates
+from polybot.config import settings
+from polybot.models import SearchSpace
+from polybot.planning import OptimizationProblem
+from surrogates import compile_predictor
+
+_my_dir = Path(__file__).parent
+
+
+@fixture()
+def opt_spec() -> OptimizationProblem:
+    with open(_my_dir / 'opt_spec.yaml') as fp:
+        spec = OptimizationProblem.parse_obj(yaml.safe_load(fp))
+    spec.search_template_path = _my_dir / 'template.json'
+    return spec
+
+
+@fixture()
+def fitted_model() -> Tuple[Pipeline, np.ndarray, float]:
+    """A fitted model, a search space, and the best observed value"""
+    rng = np.random.default_rng(1)
+    train_x = rng.uniform(0, 10, size=(32, 3))
+    train_x[:, 1] = 4  # A column to be removed by the variance threshold
+    train_y = np.sin(train_x[:, 0]) + np.cos(train_x[:, 2])
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=1.) + kernels.WhiteKernel(1e-2)
+    model = Pipeline([('variance', VarianceThreshold()), ('scale', StandardScaler()),
+                      ('gpr', GaussianProcessRegressor(kernel, optimizer=None))]).fit(train_x, train_y)
+    search_x = rng.uniform(0, 10, size=(5000, 3))
+    return model, search_x, train_y.max()
+
+
+@fixture()
+def planner(tmp_path, monkeypatch, opt_spec) -> BOPlanner:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'sample_store_path', tmp_path / 'samples.db')
+    return BOPlanner(settings.make_client_queue(), opt_spec)
+
+
+def test_checkpoint(tmp_path, planner, opt_spec):
+    client_q = planner.queues
+
+    # Fit a model to some samples in the store
+    rng = np.random.default_rng(1)
+    search_space = opt_spec.search_template.get_search_space()
+    for i in rng.choice(len(search_space), size=8, replace=False):
+        sample = opt_spec.search_template.create_new_sample()
+        sample.inputs.update(search_space.get_inputs(int(i)))
+        sample.processed_output['conductivity'] = rng.uniform()
+        planner.store.add_sample(sample)
+    train_x, train_y, _ = planner.generate_training_set()
+    out_dir = planner.output_dir / 'iteration-0'
+    out_dir.mkdir()
+    planner.iteration = 1
+    planner._fit_model(train_x, train_y, out_dir)
+
+    # Give the planner some more state to save
+    planner.n_since_refit = 2
+    planner.inference_row_cost = 1e-6
+    planner._save_checkpoint().result()
+    assert planner.checkpoint_path.is_file()
+    assert not planner.checkpoint_path.with_suffix('.tmp').exists()
+
+    # Samples that arrive after the checkpoint are not in the training set when resuming
+    sample = opt_spec.search_template.create_new_sample()
+    sample.inputs.update(search_space.get_inputs(0))
+    planner.store.add_sample(sample)
+
+    # Make sure a resumed planner has the same state and writes to the same directory
+    resumed = BOPlanner(client_q, opt_spec, resume_dir=planner.output_dir)
+    assert resumed.resumed
+    assert resumed.output_dir == planner.output_dir
+    assert resumed.iteration == 1
+    assert resumed.n_since_refit == 2
+    assert resumed.refit_lml == planner.refit_lml
+    assert resumed.inference_row_cost == 1e-6
+    assert resumed.training_set.last_sequence == planner.training_set.last_sequence
+    assert resumed.training_set.samples.get_column('ID').tolist() == planner.training_set.samples.get_column('ID').tolist()
+    assert np.array_equal(resumed.model_train_x, train_x)
+    assert resumed.model_path == out_dir / 'model.npz'
+    assert np.allclose(resumed.model.predict(train_x), planner.model.predict(train_x))
+
+    # Fit a new model if the artifact is missing
+    (out_dir / 'model.npz').unlink()
+    resumed = BOPlanner(client_q, opt_spec, resume_dir=planner.output_dir)
+    assert resumed.resumed
+    assert resumed.model is None
+    assert len(resumed.training_set.samples) == 8
+
+    # A new run directory does not resume
+    assert not BOPlanner(client_q, opt_spec, resume_dir=tmp_path).resumed
+
+
+def test_select_batch():
+    train_x = np.linspace(0, 10, 6)[:, None]
+    model = Pipeline([('scale', StandardScaler()),
+                      ('gpr', GaussianProcessRegressor(kernels.RBF(0.3) + kernels.WhiteKernel(1e-4), optimizer=None))])
+    model.fit(train_x, np.sin(train_x[:, 0]))
+    candidates = np.linspace(0, 10, 1001)[:, None]
+    max_val = np.sin(train_x[:, 0]).max()
+
+    # Without updating the model, the best points are neighbors of each other
+    y_mean, y_std = model.predict(candidates, return_std=True)
+    ei = EI(y_mean, y_std, max_val=max_val, tradeoff=0.1)
+    assert np.abs(np.diff(candidates[np.argsort(-ei)[:4], 0])).min() < 0.05
+
+    for strategy in ['kriging_believer', 'constant_liar']:
+        chosen = select_batch(model, candidates, 4, max_val, strategy=strategy)
+        assert len(set(chosen)) == 4
+        assert chosen[0] == np.argmax(ei)
+
+        # Each fantasy update lowers the uncertainty near the chosen points, spreading out the batch
+        chosen_x = candidates[chosen, 0]
+        assert np.abs(chosen_x[:, None] - chosen_x[None, :])[np.triu_indices(4, 1)].min() > 0.5
+
+    # Never choose more points than there are candidates
+    assert sorted(select_batch(model, candidates[:3], 8, max_val)) == [0, 1, 2]
+    with raises(ValueError):
+        select_batch(model, candidates, 2, max_val, strategy='unknown')
+
+
+def test_one_iteration_at_a_time(planner, mocker):
+    active = []
+    overlapped = []
+
+    def _fake_iteration():
+        active.append(1)
+        overlapped.append(len(active) > 1)
+        sleep(0.1)
+        active.pop()
+    mocker.patch.object(planner, '_perform_bo', side_effect=_fake_iteration)
+
+    # Start iterations from the cold-start and the result handler at the same time
+    threads = [Thread(target=planner.perform_bo) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == [False, False]
+
+
+def test_update_model(planner, mocker):
+    rng = np.random.default_rng(1)
+    train_x = rng.uniform(0, 10, size=(24, 2))
+    train_y = np.sin(train_x[:, 0]) + np.cos(train_x[:, 1])
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=1.) + kernels.WhiteKernel(1e-2)
+    planner.opt_spec.planner_options.update({'refit_interval': 5, 'lml_drift_tolerance': 0.25})
+
+    def _set_model(n_since_refit: int = 0):
+        """Fit the previous model to the first 20 points"""
+        model = Pipeline([('scale', StandardScaler()), ('gpr', GaussianProcessRegressor(kernel))])
+        model.fit(train_x[:20], train_y[:20])
+        planner.model = model
+        planner.model_train_x = train_x[:20]
+        planner.n_since_refit = n_since_refit
+        planner.refit_lml = model['gpr'].log_marginal_likelihood_value_ / 20
+
+    # Add points with the same hyperparameters
+    _set_model()
+    model = planner._update_model(train_x[:22], train_y[:22])
+    assert model is planner.model
+    assert planner.n_since_refit == 2
+    refit = Pipeline([('scale', model['scale']),
+                      ('gpr', GaussianProcessRegressor(model['gpr'].kernel_, optimizer=None))])
+    refit['gpr'].fit(model['scale'].transform(train_x[:22]), train_y[:22])
+    assert np.allclose(model.predict(train_x), refit.predict(train_x), atol=1e-10)
+
+    # Fit from scratch if the earlier points changed
+    _set_model()
+    changed_x = train_x[:22].copy()
+    changed_x[0] += 1
+    assert planner._update_model(changed_x, train_y[:22]) is None
+
+    # Fit from scratch after adding enough points
+    _set_model(n_since_refit=3)
+    assert planner._update_model(train_x[:22], train_y[:22]) is None
+
+    # Fit from scratch if the hyperparameters no longer fit the data
+    _set_model()
+    planner.refit_lml += 1
+    assert planner._update_model(train_x[:22], train_y[:22]) is None
+
+    # Fit from scratch if the kernel matrix cannot be factorized
+    _set_model()
+    mocker.patch('planner.add_training_points', side_effect=np.linalg.LinAlgError())
+    assert planner._update_model(train_x[:22], train_y[:22]) is None
+
+
+def test_acquisition(fitted_model):
+    model, search_x, max_val = fitted_model
+    y_mean, y_std = model.predict(search_x, return_std=True)
+    ei = EI(y_mean, y_std, max_val=max_val, tradeoff=0.1)
+    predictor = compile_predictor(model)
+
+    # Merging the best points of each chunk gives the best points overall, regardless of the chunk size
+    top_k = 8
+    exclude = np.argsort(-ei)[:2]  # Skip the best two points
+    expected = set(np.argsort(-ei)[2:top_k + 2])
+    for chunk_size in [1000, 1300, 5000]:
+        best_points = []
+        for start in range(0, len(search_x), chunk_size):
+            chunk_exclude = exclude[(exclude >= start) & (exclude < start + chunk_size)] - start
+            inds, scores = run_acquisition(predictor, search_x[start:start + chunk_size], max_val, 0.1, top_k,
+                                           chunk_exclude)
+            assert len(inds) == min(top_k, len(search_x[start:start + chunk_size]) - len(chunk_exclude))
+            assert np.allclose(scores, ei[start + inds])
+            merge_best_points(best_points, start, inds, scores, top_k)
+        assert set(ind for _, ind in best_points) == expected
+
+    # Return every point if there are fewer than requested
+    inds, _ = run_acquisition(predictor, search_x[:5], max_val, 0.1, top_k, np.array([0, 3]))
+    assert sorted(inds) == [1, 2, 4]
+
+
+def test_screening(fitted_model):
+    model, search_x, max_val = fitted_model
+    predictor = compile_predictor(model)
+
+    # Screening finds the same points as evaluating every point, including when excluding the best points
+    y_mean, y_std = model.predict(search_x, return_std=True)
+    ei = EI(y_mean, y_std, max_val=max_val, tradeoff=0.1)
+    for exclude in [None, np.argsort(-ei)[:3]]:
+        for top_k in [1, 8, 64]:
+            inds, scores = run_acquisition(predictor, search_x, max_val, 0.1, top_k, exclude, screen=True)
+            expected_inds, expected_scores = run_acquisition(predictor, search_x, max_val, 0.1, top_k, exclude)
+            assert set(inds) == set(expected_inds)
+            assert np.allclose(np.sort(scores), np.sort(expected_scores))
+
+            # Even when computing the exact values for a few points at a time
+            inds, scores = screen_candidates(predictor, search_x, max_val, 0.1, top_k, exclude, block_size=16)
+            assert set(inds) == set(expected_inds)
+            assert np.allclose(np.sort(scores), np.sort(expected_scores))
+
+    # Return every point if there are fewer than requested
+    inds, _ = run_acquisition(predictor, search_x[:5], max_val, 0.1, 8, np.array([0, 3]), screen=True)
+    assert sorted(inds) == [1, 2, 4]
+
+
+def test_shared_inputs(planner, fitted_model, tmp_path):
+    model, _, max_val = fitted_model
+    predictor = compile_predictor(model)
+    search_space = SearchSpace(['x', 'y', 'z'], [np.linspace(0, 10, 20), [4.], np.linspace(0, 10, 25)])
+    planner.opt_spec.planner_options['shared_dir'] = str(tmp_path / 'shm')
+    shared_dir = planner.shared_dir
+    shared_dir.mkdir(parents=True)
+    stale_path = shared_dir / 'search-space-old-float64.npy'
+    np.save(stale_path, np.zeros((2, 3)))
+
+    # Write the files, using chunks which do not evenly divide the search space
+    model_path, search_path = planner._write_shared_inputs(predictor, search_space, chunk_size=64)
+    assert np.array_equal(np.load(search_path), search_space.get_chunk(0, len(search_space)))
+    assert not stale_path.exists()
+
+    # Make sure the tasks see the same inputs
+    chunk = search_space.get_chunk(100, 200)
+    inds, scores = run_acquisition_on_shared(str(model_path), str(search_path), 100, 200, max_val, 0.1, 4)
+    expected_inds, expected_scores = run_acquisition(predictor, chunk, max_val, 0.1, 4)
+    assert set(inds) == set(expected_inds)
+    assert np.allclose(np.sort(scores), np.sort(expected_scores))
+
+    # The next iteration writes a new model, but reuses the search space
+    planner.iteration += 1
+    mtime = search_path.stat().st_mtime_ns
+    new_model_path, new_search_path = planner._write_shared_inputs(predictor, search_space, chunk_size=64)
+    assert new_model_path != model_path
+    assert new_search_path == search_path and search_path.stat().st_mtime_ns == mtime
+
+    planner._remove_shared_dir()
+    assert not shared_dir.exists()
+
+
+def test_chunk_size():
+    # Give each worker several chunks
+    assert choose_chunk_size(10 ** 6, 4, 8, memory_budget=1e9) == 62500
+    assert choose_chunk_size(10 ** 6, 4, 8, memory_budget=1e9, chunks_per_worker=1) == 250000
+
+    # Small grids are evaluated in a single chunk, rather than many tiny ones
+    assert choose_chunk_size(100, 4, 8, memory_budget=1e9) == 100
+    assert choose_chunk_size(1, 0, 8, memory_budget=1e9) == 1
+
+    # Chunks shrink to fit in memory and to finish in time
+    assert choose_chunk_size(10 ** 6, 4, 1000, memory_budget=1e7) == 10000
+    assert choose_chunk_size(10 ** 6, 4, 8, memory_budget=1e9, row_cost=1e-3, max_task_time=5) == 5000
+    assert choose_chunk_size(10 ** 6, 4, 8, memory_budget=1e9, row_cost=1e-3) == 62500  # No time limit
+
+    # ... but never below the minimum size
+    assert choose_chunk_size(10 ** 6, 4, 1000, memory_budget=1e4) == 1000
+    assert choose_chunk_size(10 ** 6, 4, 1000, memory_budget=1e4, min_chunk_size=50) == 50
@@ -0,0 +1,115 @@
+import pickle as pkl
+
+import numpy as np
+from modAL.acquisition import EI
+from pytest import fixture, mark, raises
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.gaussian_process import GaussianProcessRegressor, kernels
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from surrogates import SparseGPR, add_training_points, compile_predictor
+
+
+@fixture()
+def data():
+    rng = np.random.default_rng(1)
+    train_x = rng.uniform(0, 10, size=(64, 3))
+    train_x[:, 1] = 4  # A column to be removed by the variance threshold
+    train_y = np.sin(train_x[:, 0]) + np.cos(train_x[:, 2])
+    search_x = rng.uniform(0, 10, size=(4096, 3))
+    return train_x, train_y, search_x
+
+
+def make_model(surrogate) -> Pipeline:
+    return Pipeline([
+        ('variance', VarianceThreshold()),
+        ('scale', StandardScaler()),
+        ('gpr', surrogate)
+    ])
+
+
+def test_add_training_points(data):
+    train_x, train_y, search_x = data
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=[1., 2., 1.]) + kernels.WhiteKernel(1e-2)
+    gpr = GaussianProcessRegressor(kernel, optimizer=None).fit(train_x[:48], train_y[:48])
+
+    # Add several points at once, and change the outputs of the existing points
+    new_y = 2 * train_y + 1
+    add_training_points(gpr, train_x[48:], new_y)
+    refit = GaussianProcessRegressor(kernel, optimizer=None).fit(train_x, new_y)
+    assert np.allclose(gpr.L_, refit.L_, atol=1e-12)
+    assert np.allclose(gpr.alpha_, refit.alpha_, atol=1e-10)
+    assert np.isclose(gpr.log_marginal_likelihood_value_, refit.log_marginal_likelihood_value_, atol=1e-10)
+    for a, b in zip(gpr.predict(search_x, return_std=True), refit.predict(search_x, return_std=True)):
+        assert np.allclose(a, b, atol=1e-10)
+
+    with raises(ValueError):
+        add_training_points(gpr, train_x[:2], new_y)
+
+
+def test_compiled_predictor(data):
+    train_x, train_y, search_x = data
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=[1., 1.]) + kernels.WhiteKernel(1e-2)
+    for surrogate in [GaussianProcessRegressor(kernel, optimizer=None),
+                      GaussianProcessRegressor(kernels.Matern(length_scale=1.), optimizer=None)]:
+        model = make_model(surrogate).fit(train_x, train_y)
+        predictor = compile_predictor(model)
+        y_mean, y_std = model.predict(search_x, return_std=True)
+        pred_mean, pred_std = predictor.predict_mean_std(search_x)
+        assert np.allclose(pred_mean, y_mean, atol=1e-6)
+        assert np.allclose(pred_std, y_std, atol=1e-6)
+        assert np.all(predictor.prior_std(predictor.transform(search_x)) >= pred_std - 1e-8)
+
+    # The sparse model is exact when every point is an inducing point
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=[0.3, 0.3]) + kernels.WhiteKernel(1e-2)
+    exact = make_model(GaussianProcessRegressor(kernel, optimizer=None)).fit(train_x, train_y)
+    sparse = make_model(SparseGPR(kernel, n_inducing=len(train_x), optimizer=None)).fit(train_x, train_y)
+    y_mean, y_std = exact.predict(search_x, return_std=True)
+    assert np.allclose(sparse.predict(search_x), y_mean, atol=1e-4)
+    pred_mean, pred_std = compile_predictor(sparse).predict_mean_std(search_x)
+    assert np.allclose(pred_mean, y_mean, atol=1e-4)
+    assert np.allclose(pred_std, y_std, atol=1e-4)
+
+
+def test_predictor_parity(data):
+    """Compiled predictions must match the pipeline, regardless of how the points are split into blocks"""
+    train_x, train_y, search_x = data
+    kernel = kernels.ConstantKernel(1.) * kernels.RBF(length_scale=1.) + kernels.WhiteKernel(1e-2)
+    for surrogate in [GaussianProcessRegressor(kernel), SparseGPR(kernel, n_inducing=16, random_state=1)]:
+        model = make_model(surrogate).fit(train_x, train_y)
+        y_mean, y_std = model.predict(search_x, return_std=True)
+
+        # Use blocks which do not evenly divide the points, and a copy sent between processes
+        predictor = compile_predictor(model)
+        predictor.block_size = 1000
+        for pred in [predictor, pkl.loads(pkl.dumps(predictor))]:
+            pred_mean, pred_std = pred.predict(search_x, return_std=True)
+            assert np.allclose(pred_mean, y_mean, atol=1e-6)
+            assert np.allclose(pred_std, y_std, atol=1e-6)
+            assert np.allclose(pred.predict(search_x[:10]), y_mean[:10], atol=1e-6)
+
+
+@mark.parametrize('kernel', [kernels.ConstantKernel(1.) * kernels.RBF(length_scale=1.) + kernels.WhiteKernel(1e-2),
+                             kernels.ConstantKernel(1.) * kernels.Matern(length_scale=1.) + kernels.WhiteKernel(1e-2)])
+def test_float32(data, kernel):
+    train_x, train_y, search_x = data
+    model = make_model(GaussianProcessRegressor(kernel)).fit(train_x, train_y)
+    predictor = compile_predictor(model)
+    predictor_32 = predictor.astype('float32')
+
+    y_mean, y_std = predictor.predict_mean_std(search_x)
+    mean_32, std_32 = predictor_32.predict_mean_std(search_x.astype(np.float32))
+    assert mean_32.dtype == np.float32 and std_32.dtype == np.float32
+    assert predictor.dtype == np.float64  # Original is unchanged
+
+    # The rankings by EI should be nearly the same
+    max_val = train_y.max()
+    ei = EI(y_mean, y_std, max_val=max_val, tradeoff=0.1)
+    ei_32 = EI(mean_32.astype(np.float64), std_32.astype(np.float64), max_val=max_val, tradeoff=0.1)
+    assert np.abs(ei_32 - ei).max() < 1e-2 * ei.max()
+    top_k = 32
+    best = set(np.argsort(-ei)[:top_k])
+    best_32 = set(np.argsort(-ei_32)[:top_k])
+    assert len(best & best_32) >= top_k - 4
+    assert np.argmax(ei_32) in set(np.argsort(-ei)[:3])
@@ -0,0 +1,143 @@
+"""Content-addressed, on-disk cache for sample files downloaded from the Argonne Data Cloud
+
+Files are stored under the hash of their contents, and an index maps the ID of each
+sample record to the hash of its file. Sample files are never modified once written,
+so a cached copy can be used in place of downloading the file again.
+"""
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import Union, Optional
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class SampleFileCache:
+    """Size-bounded cache of sample files
+
+    The least-recently-used files are evicted once the total size of the cache exceeds
+    its limit. Use is tracked with the modification time of each file,
+    which is updated each time a file is read.
+    """
+
+    def __init__(self, path: Union[str, Path], max_size: int):
+        """
+        Args:
+            path: Directory holding the cache. Will be created if it does not exist
+            max_size: Maximum total size of the cached files, in bytes
+        """
+        self.path = Path(path)
+        self.max_size = max_size
+        self._objects_dir = self.path / 'objects'
+        self._index_dir = self.path / 'index'
+        self._objects_dir.mkdir(parents=True, exist_ok=True)
+        self._index_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = Lock()
+        self._total_size = self._measure_size()
+
+    @property
+    def total_size(self) -> int:
+        """Total size of the files in the cache, in bytes"""
+        return self._total_size
+
+    def _index_path(self, sample_id: str) -> Path:
+        # Sample IDs may contain characters that are not allowed in filenames, so we use their hash
+        return self._index_dir / sha256(sample_id.encode()).hexdigest()
+
+    def get(self, sample_id: str) -> Optional[str]:
+        """Retrieve a sample file from the cache
+
+        Args:
+            sample_id: ID of the sample record
+        Returns:
+            Contents of the file, if it is in the cache. ``None`` otherwise
+        """
+        try:
+            content_hash = self._index_path(sample_id).read_text()
+            object_path = self._objects_dir / f'{content_hash}.json'
+            data = object_path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        # Check the file was not corrupted, then mark it as recently used
+        if sha256(data).hexdigest() != content_hash:
+            logger.warning(f'Cached file for sample {sample_id} is corrupted. Removing it from the cache')
+            with self._lock:
+                self._remove_unlocked(object_path)
+                self._total_size = self._measure_size()  # The corrupted file may have changed size
+            return None
+
+        # Another thread may evict the file once we have read it, which we treat as a miss
+        with self._lock:
+            try:
+                os.utime(object_path)
+            except FileNotFoundError:
+                return None
+        return data.decode()
+
+    def put(self, sample_id: str, data: str):
+        """Add a sample file to the cache
+
+        Args:
+            sample_id: ID of the sample record
+            data: Contents of the file
+        """
+        data = data.encode()
+        content_hash = sha256(data).hexdigest()
+        object_path = self._objects_dir / f'{content_hash}.json'
+
+        # Write the file, if it is not already present, then the index entry
+        #  Files are written to a temporary path then moved so that readers never see partial files
+        with self._lock:
+            if not object_path.is_file():
+                _atomic_write(object_path, data)
+                self._total_size += len(data)
+        _atomic_write(self._index_path(sample_id), content_hash.encode())
+
+        self._evict()
+
+    def _measure_size(self) -> int:
+        """Compute the total size of the files in the cache"""
+        return sum(p.stat().st_size for p in self._objects_dir.glob('*.json'))
+
+    def _remove_unlocked(self, object_path: Path):
+        """Remove a file from the cache. Caller must hold the lock"""
+        try:
+            size = object_path.stat().st_size
+            object_path.unlink()
+        except FileNotFoundError:
+            return
+        self._total_size -= size
+
+    def _evict(self):
+        """Remove the least-recently-used files until the cache is below its maximum size"""
+        with self._lock:
+            if self._total_size <= self.max_size:
+                return
+
+            # Index entries for removed files are left in place, and are treated as misses by `get`
+            objects = []
+            for object_path in self._objects_dir.glob('*.json'):
+                try:
+                    objects.append((object_path.stat().st_mtime, object_path))
+                except FileNotFoundError:
+                    continue
+            for _, object_path in sorted(objects):
+                if self._total_size <= self.max_size:
+                    break
+                self._remove_unlocked(object_path)
+
+
+def _atomic_write(path: Path, data: bytes):
+    """Write data to a file such that it is either fully written or not present
+
+    Args:
+        path: Path to the file
+        data: Data to be written
+    """
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.{id(data)}.tmp')
+    temp_path.write_bytes(data)
+    os.replace(temp_path, path)
@@ -58,6 +58,11 @@ def launch_planner(args: Namespace):
     cls = _load_object(args.planning_class)
     logger.info(f'Loaded planning class: {cls}')
 
+    # Make the planner before launching any other processes, as it may reject the options
+    client_q = settings.make_client_queue()
+    kwargs = {} if args.resume is None else {'resume_dir': args.resume}
+    planner = cls(client_q, opt_info, daemon=True, **kwargs)
+
     # Build and launch the Colmena task server, if desired
     task_server: Optional[BaseTaskServer] = None
     is_linux = system() == 'Linux'
@@ -73,8 +78,6 @@ def launch_planner(args: Namespace):
             task_server.start()
 
     # Start the planner process
-    client_q = settings.make_client_queue()
-    planner = cls(client_q, opt_info, daemon=True)
     planner.start()  # Run in a separate thread
 
     # Wait until the planner finishes or timeout is reached
@@ -83,6 +86,9 @@ def launch_planner(args: Namespace):
     finally:
         planner.done.set()  # Tells the planner to shutdown
         if task_server is not None and is_linux:
+            # Give the task server a chance to stop its workers
+            client_q.send_kill_signal()
+            task_server.join(timeout=30)
             task_server.kill()
 
 
@@ -132,7 +138,11 @@ def create_parser() -> ArgumentParser:
                                 help='Class defining the planning algorithm in format: module.path:ClassName')
     planner_parser.add_argument('--task-server', '-t', default=None,
                                 help='Function that creates a TaskServer given task server queues. '
-                                     'Format: module.path:function_name')
+                                     'Format: module.path:function_name. '
+                                     'Use polybot.planning:build_process_pool_executor to run tasks on every core')
+    planner_parser.add_argument('--resume', default=None,
+                                help='Output directory of a previous run to resume from. '
+                                     'Only for planning classes which support resuming')
     planner_parser.add_argument('--timeout', default=None, type=float, help='Maximum runtime for the planning service. '
                                                                             'Used for debugging.')
     planner_parser.add_argument("opt_config", help="Path to the optimization configuration file.")
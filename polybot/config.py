@@ -7,6 +7,8 @@ from adc_sdk.client import ADCClient
 from colmena.redis.queue import ClientQueues, TaskServerQueues
 from pydantic import BaseSettings, Field, HttpUrl, RedisDsn
 
+from polybot.cache import SampleFileCache
+
 _run_folder = Path.cwd()
 
 
@@ -17,6 +19,17 @@ class Settings(BaseSettings):
     adc_access_token: Optional[str] = Field(None, description='Token for accessing the Argonne Data Cloud')
     adc_study_id: Optional[str] = Field(None, description='Study ID associated with this experiment')
 
+    adc_download_workers: int = Field(8, description='Maximum number of sample files to download from ADC concurrently')
+    adc_download_retries: int = Field(3, description='Number of times to retry a failed sample download')
+    adc_download_timeout: float = Field(30, description='Timeout for each sample download, in seconds')
+    adc_retry_backoff: float = Field(0.5, description='Time to wait before the first retry of a download, in seconds.'
+                                                      ' Doubles with each subsequent retry')
+    sample_cache_dir: Optional[Path] = Field(None, description='Directory in which to cache sample files downloaded '
+                                                               'from ADC. Files are not cached if not provided')
+    sample_cache_size: float = Field(1024, description='Maximum size of the sample file cache in MB')
+    sample_store_path: Optional[Path] = Field(None, description='Path to a local database holding copies of samples'
+                                                                ' from the study. Used to avoid re-downloading samples')
+
     # Logging
     log_name: Optional[str] = Field(None, description="Name of the log file. If not provided, logs will not be stored")
     log_size: int = Field(1, description="Maximum log size in MB")
@@ -27,10 +40,18 @@ class Settings(BaseSettings):
 
     # Interface with the controller
     robot_url: Optional[HttpUrl] = Field(None, description="Address of the robotic controller system")
+    robot_timeout: float = Field(30, description="Timeout for requests to the robotic controller, in seconds")
+    robot_retries: int = Field(3, description="Number of times to retry a failed request to the robotic controller")
+    robot_retry_backoff: float = Field(1, description="Time to wait before the first retry of a request to the robotic"
+                                                      " controller, in seconds. Doubles with each subsequent retry")
 
     # Settings for the Colmena task server
     task_queues: Optional[List[str]] = Field(['compute'],
                                              description='Additional task queues to create for the Colmena service')
+    task_workers: Optional[int] = Field(None, description='Number of worker processes used by the process-pool task server.'
+                                                          ' Default is to use one per CPU core')
+    task_worker_threads: int = Field(1, description='Number of threads used by the math libraries (e.g., BLAS)'
+                                                    ' in each worker of the process-pool task server')
 
     @property
     def redis_info(self) -> Tuple[str, int]:
@@ -68,6 +89,16 @@ class Settings(BaseSettings):
         hostname, port = self.redis_info
         return TaskServerQueues(hostname, port, name='polybot', topics=['robot'] + self.task_queues)
 
+    def make_sample_cache(self) -> Optional[SampleFileCache]:
+        """Create the cache for sample files, if enabled
+
+        Returns:
+            Cache in the configured directory, or ``None`` if no directory is set
+        """
+        if self.sample_cache_dir is None:
+            return None
+        return SampleFileCache(self.sample_cache_dir, int(self.sample_cache_size * 1024 ** 2))
+
     def generate_adc_client(self) -> ADCClient:
         """Create an authenticated ADC client
 
@@ -1,12 +1,49 @@
 """Data models for objects used by this service"""
-from typing import List, Dict, Any, Optional, Tuple, Iterable, Union
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Union, Callable
 from itertools import product
+from pathlib import Path
+import json
 from uuid import uuid4
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 import pandas as pd
 import numpy as np
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    """Parse JSON using orjson, if available
+
+    Falls back to the standard library for documents that orjson rejects,
+    such as those containing the ``NaN`` and ``Infinity`` values written by :meth:`_json_dumps`
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def _numpy_default(obj: Any, default: Callable[[Any], Any]) -> Any:
+    """Convert numpy types to Python types before falling back to another encoder"""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    return default(obj)
+
+
+def _json_dumps(obj: Any, *, default: Callable[[Any], Any], **kwargs) -> str:
+    """Serialize to JSON using the standard library
+
+    Does not use orjson, which writes non-finite numbers as ``null``,
+    so that ``NaN`` and ``Infinity`` are preserved regardless of the formatting options.
+    """
+    return json.dumps(obj, default=lambda x: _numpy_default(x, default), **kwargs)
+
 
 class Sample(BaseModel):
     """Description for a UVVis experiment"""
@@ -36,6 +73,341 @@ class Sample(BaseModel):
 
     class Config:
         extra = 'allow'
+        json_loads = _json_loads
+        json_dumps = _json_dumps
+
+
+def parse_samples(payloads: Iterable[Union[str, bytes, dict]], trusted: bool = False) -> List[Sample]:
+    """Parse many samples at once
+
+    Args:
+        payloads: JSON documents or dictionaries describing each sample
+        trusted: Whether to skip validation. Only use for data written by polybot,
+            such as samples read back from a :class:`~polybot.store.SampleStore`
+    Returns:
+        List of parsed samples
+    """
+    output = []
+    for payload in payloads:
+        data = payload if isinstance(payload, dict) else _json_loads(payload)
+        output.append(Sample.construct(**data) if trusted else Sample.parse_obj(data))
+    return output
+
+
+def _get_value(sample: Sample, path: str) -> Any:
+    """Get a value from a sample given its path
+
+    Args:
+        sample: Sample from which to retrieve a value
+        path: Dotted path to the value (e.g., ``processed_output.sample_quality.defective``).
+            The first part is the name of a field of the sample. Keys of nested dictionaries
+            may contain dots themselves, and are matched by the longest key that is present
+    Returns:
+        The value, or ``None`` if it is not present
+    """
+    field, *parts = path.split('.')
+    return _lookup(getattr(sample, field, None), parts)
+
+
+def _lookup(obj: Any, parts: List[str]) -> Any:
+    """Find a value in a nested dictionary, allowing for keys that contain dots"""
+    if len(parts) == 0:
+        return obj
+    if not isinstance(obj, dict):
+        return None
+    for i in range(len(parts), 0, -1):
+        key = '.'.join(parts[:i])
+        if key in obj:
+            return _lookup(obj[key], parts[i:])
+    return None
+
+
+def _flatten(obj: Dict[str, Any], prefix: str) -> Iterator[str]:
+    """Get the paths to all values in a nested dictionary that are not themselves dictionaries"""
+    for key, value in obj.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{prefix}.{key}')
+        else:
+            yield f'{prefix}.{key}'
+
+
+class SampleCollection:
+    """A group of samples whose values are accessed column-wise
+
+    Values are identified by their dotted path within a sample
+    (e.g., ``processed_output.sample_quality.defective`` or ``inputs.coating_on_top.T``).
+    The values of each path are gathered from every sample the first time the path is used,
+    then kept and extended as samples are added.
+    """
+
+    def __init__(self, samples: Iterable[Sample] = ()):
+        """
+        Args:
+            samples: Initial samples in the collection
+        """
+        self.samples: List[Sample] = []
+        self._columns: Dict[str, List[Any]] = {}
+        self.extend(samples)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def extend(self, samples: Iterable[Sample]):
+        """Add samples to the collection
+
+        Args:
+            samples: Samples to be added
+        """
+        new_samples = list(samples)
+        self.samples.extend(new_samples)
+        for path, column in self._columns.items():
+            column.extend(_get_value(s, path) for s in new_samples)
+
+    def get_column(self, path: str, dtype: Optional[Union[str, np.dtype]] = None) -> np.ndarray:
+        """Get the value at a certain path for every sample
+
+        Args:
+            path: Dotted path to the value
+            dtype: Data type of the output array. Missing values are NaN if using a floating point type
+        Returns:
+            Array of values in the same order as the samples. Missing values are ``None`` unless a dtype is provided
+        """
+        if path not in self._columns:
+            self._columns[path] = [_get_value(s, path) for s in self.samples]
+        return np.array(self._columns[path], dtype=dtype)
+
+    def get_mask(self, filters: Optional[Dict[str, Callable[[np.ndarray], np.ndarray]]] = None) -> np.ndarray:
+        """Determine which samples pass a set of filters
+
+        Args:
+            filters: Map of dotted path to a function that receives the column of values at that path
+                and returns whether each sample passes the filter
+        Returns:
+            Whether each sample passes all filters
+        """
+        mask = np.ones((len(self),), dtype=bool)
+        for path, function in (filters or {}).items():
+            mask &= np.asarray(function(self.get_column(path)), dtype=bool)
+        return mask
+
+    def get_inputs(self, input_columns: List[str]) -> np.ndarray:
+        """Get the inputs of every sample as an array
+
+        Args:
+            input_columns: Names of the inputs
+        Returns:
+            2D array where each row is a sample and each column is an input
+        """
+        output = np.empty((len(self), len(input_columns)))
+        for i, column in enumerate(input_columns):
+            output[:, i] = self.get_column(f'inputs.{column}', dtype=float)
+        return output
+
+    def to_arrays(self, input_columns: List[str], output: str,
+                  filters: Optional[Dict[str, Callable[[np.ndarray], np.ndarray]]] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """Get the inputs and an output of samples as arrays
+
+        Samples where the output is missing are excluded.
+
+        Args:
+            input_columns: Names of the inputs
+            output: Dotted path to the output (e.g., ``processed_output.conductivity``)
+            filters: Filters to apply to the samples. See :meth:`get_mask`
+        Returns:
+            - Inputs of the selected samples
+            - Output of the selected samples
+        """
+        y = self.get_column(output, dtype=float)
+        mask = self.get_mask(filters) & ~np.isnan(y)
+        return self.get_inputs(input_columns)[mask], y[mask]
+
+    def to_dataframe(self, paths: Optional[List[str]] = None) -> pd.DataFrame:
+        """Get the values from the samples as a DataFrame
+
+        Args:
+            paths: Paths of the values to include. By default, includes the ID, all inputs and all processed outputs
+        Returns:
+            DataFrame with a column for each path and a row for each sample
+        """
+        if paths is None:
+            paths = {'ID': None}  # Use a dictionary as an ordered set
+            for group in ['inputs', 'processed_output']:
+                for sample in self.samples:
+                    paths.update(dict.fromkeys(_flatten(getattr(sample, group), group)))
+        return pd.DataFrame(dict((path, self.get_column(path)) for path in paths))
+
+    def to_arrow(self, paths: Optional[List[str]] = None) -> 'pyarrow.Table':  # noqa: F821
+        """Get the values from the samples as an Arrow table. Requires ``pyarrow``
+
+        Args:
+            paths: Paths of the values to include. See :meth:`to_dataframe`
+        Returns:
+            Table with a column for each path and a row for each sample
+        """
+        import pyarrow
+        return pyarrow.Table.from_pandas(self.to_dataframe(paths), preserve_index=False)
+
+    def to_parquet(self, path: Union[str, Path], paths: Optional[List[str]] = None):
+        """Save the values from the samples to a Parquet file. Requires ``pyarrow``
+
+        Args:
+            path: Path to the output file
+            paths: Paths of the values to include. See :meth:`to_dataframe`
+        """
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(self.to_arrow(paths), str(path))
+
+
+class SearchSpace:
+    """Lazy view of every point in the search space described by a :class:`SampleTemplate`
+
+    Points are never stored in memory. Each point is identified by an integer index
+    and generated on demand with mixed-radix arithmetic: the index is a number whose
+    "digits" are the positions in the list of acceptable values for each input,
+    with the last column varying fastest.
+
+    Supports ``len()``, indexing by integers, slices or arrays of indices,
+    iterating over the space in chunks, and random sampling of indices.
+    """
+
+    def __init__(self, columns: List[str], acceptable_values: List[np.ndarray],
+                 dtype: Union[str, np.dtype] = np.float64):
+        """
+        Args:
+            columns: Names of each input, in the order of the columns
+            acceptable_values: List of acceptable values for each input
+            dtype: Data type of the generated points
+        """
+        self.columns = list(columns)
+        self.acceptable_values = [np.asarray(v) for v in acceptable_values]
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(len(v) for v in self.acceptable_values)
+
+        # The place value of each digit is the product of the sizes of all later columns
+        self.strides = np.ones((len(self.shape),), dtype=np.int64)
+        for i in range(len(self.shape) - 2, -1, -1):
+            self.strides[i] = self.strides[i + 1] * self.shape[i + 1]
+        self._size = int(self.strides[0] * self.shape[0]) if len(self.shape) > 0 else 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, item: Union[int, slice, Iterable[int]]) -> np.ndarray:
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError(f'Index {item} is out of range for a search space of {len(self)} points')
+            return self.get_points([item])[0]
+        elif isinstance(item, slice):
+            return self.get_points(np.arange(*item.indices(len(self))))
+        return self.get_points(item)
+
+    def get_points(self, indices: Iterable[int]) -> np.ndarray:
+        """Generate the points at specific indices
+
+        Args:
+            indices: Indices of the desired points
+        Returns:
+            2D array where each row is a point, in the same order as the indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        output = np.empty((len(indices), len(self.columns)), dtype=self.dtype)
+        for i, (values, stride, size) in enumerate(zip(self.acceptable_values, self.strides, self.shape)):
+            output[:, i] = values[(indices // stride) % size]
+        return output
+
+    def get_chunk(self, start: int, length: int) -> np.ndarray:
+        """Generate a contiguous range of points
+
+        Args:
+            start: Index of the first point
+            length: Maximum number of points to generate
+        Returns:
+            2D array of the points
+        """
+        return self.get_points(np.arange(start, min(start + length, len(self))))
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[Tuple[int, np.ndarray]]:
+        """Generate the search space in chunks
+
+        Args:
+            chunk_size: Number of points per chunk. The last chunk may be smaller
+        Yields:
+            - Index of the first point in the chunk
+            - Points in the chunk
+        """
+        for start in range(0, len(self), chunk_size):
+            yield start, self.get_chunk(start, chunk_size)
+
+    def get_indices(self, points: np.ndarray) -> np.ndarray:
+        """Find the indices of points within the search space
+
+        Args:
+            points: 2D array where each row is a point
+        Returns:
+            Index of each point, or -1 for points that are not in the search space
+        """
+        points = np.asarray(points, dtype=self.dtype).reshape(-1, len(self.columns))
+        output = np.zeros((len(points),), dtype=np.int64)
+        found = np.ones((len(points),), dtype=bool)
+        for i, (values, stride) in enumerate(zip(self.acceptable_values, self.strides)):
+            # Match each value to the nearest acceptable value, as the points may have been rounded
+            values = values.astype(self.dtype)
+            order = np.argsort(values)
+            pos = np.clip(np.searchsorted(values[order], points[:, i]), 1, max(len(values) - 1, 1))
+            left, right = order[pos - 1], order[np.minimum(pos, len(values) - 1)]
+            nearest = np.where(np.abs(values[left] - points[:, i]) <= np.abs(values[right] - points[:, i]), left, right)
+            found &= np.isclose(values[nearest], points[:, i])
+            output += nearest * stride
+        output[~found] = -1
+        return output
+
+    def get_inputs(self, index: int) -> Dict[str, Any]:
+        """Get the inputs for a single point
+
+        Values retain the type of the acceptable values for each input,
+        rather than being cast to the data type of the search space.
+
+        Args:
+            index: Index of the point
+        Returns:
+            Dictionary of the value of each input
+        """
+        if not 0 <= index < len(self):
+            raise IndexError(f'Index {index} is out of range for a search space of {len(self)} points')
+        return dict(
+            (c, values[(index // stride) % size].item())
+            for c, values, stride, size in zip(self.columns, self.acceptable_values, self.strides, self.shape)
+        )
+
+    def sample_indices(self, n: int, random_state: Optional[Union[int, np.random.Generator]] = None) -> np.ndarray:
+        """Select indices of points uniformly at random, without replacement
+
+        Args:
+            n: Number of indices to select
+            random_state: Seed or random number generator
+        Returns:
+            Array of the selected indices
+        """
+        rng = np.random.default_rng(random_state)
+        return rng.choice(len(self), size=n, replace=False)
+
+    def to_array(self) -> np.ndarray:
+        """Generate all points in the search space as a single array
+
+        Fills a preallocated array by broadcasting the acceptable values of each input
+        along its own axis of the grid, which is much faster than computing each point from its index.
+
+        Returns:
+            2D array where each row is a point, in the order of their indices
+        """
+        n_columns = len(self.columns)
+        output = np.empty(self.shape + (n_columns,), dtype=self.dtype)
+        for i, values in enumerate(self.acceptable_values):
+            output[..., i] = values.reshape([-1 if j == i else 1 for j in range(n_columns)])
+        return output.reshape(-1, n_columns)
 
 
 class SampleTemplate(Sample):
@@ -43,6 +415,9 @@ class SampleTemplate(Sample):
     human-readable descriptions and the ranges over which they are allowed to vary.
 
     A superset of the information held by a :class:`Sample` object.
+
+    The acceptable values for each field and the search spaces are memoized after they are first computed,
+    so treat a template as read-only once you begin generating search spaces from it.
     """
 
     ID: Optional[str] = None
@@ -63,6 +438,19 @@ class SampleTemplate(Sample):
         default_factory=dict, help='The numerical type of the value of a field'
     )
 
+    # Memoized values derived from the template
+    _acceptable_values: Dict[str, List[Union[int, float]]] = PrivateAttr(default_factory=dict)
+    _search_spaces: Dict[str, SearchSpace] = PrivateAttr(default_factory=dict)
+    _search_space_arrays: Dict[str, np.ndarray] = PrivateAttr(default_factory=dict)
+
+    def __getstate__(self):
+        # Do not pickle the memoized values, as the search space arrays can be very large
+        state = super().__getstate__()
+        state['__private_attribute_values__'] = dict(
+            (name, attr.get_default()) for name, attr in self.__private_attributes__.items()
+        )
+        return state
+
     @property
     def input_columns(self) -> List[str]:
         """Name of the input columns to the optimization algorithm
@@ -102,7 +490,11 @@ class SampleTemplate(Sample):
         Returns:
             List of acceptable values
         """
+        if field not in self._acceptable_values:
+            self._acceptable_values[field] = self._compute_acceptable_values_for_field(field)
+        return self._acceptable_values[field]
 
+    def _compute_acceptable_values_for_field(self, field: str) -> List[Union[int, float]]:
         assert field in self.inputs_interval, f"Field \"{field}\" does not have a defined interval"
         assert field in self.inputs_dtype, f"Field \"{field}\" does not have a defined units"
 
@@ -137,6 +529,53 @@ class SampleTemplate(Sample):
         return dict((key, self.get_acceptable_values_for_field(key))
                     for key in self.inputs_space)
 
-    def generate_search_space_dataframe(self) -> pd.DataFrame:
-        """Create the search space as a Pandas DataFrame"""
+    def get_search_space(self, dtype: Optional[Union[str, np.dtype]] = None) -> SearchSpace:
+        """Get a lazy view of all possible values of the new samples
+
+        Args:
+            dtype: Data type of the points. Defaults to the common type of all fields in ``inputs_dtype``
+        Returns:
+            Search space with columns in the order given by :attr:`input_columns`
+        """
+        columns = self.input_columns
+        if dtype is None:
+            dtype = np.result_type(*[self.inputs_dtype[c] for c in columns])
+        key = np.dtype(dtype).str
+        if key not in self._search_spaces:
+            self._search_spaces[key] = SearchSpace(columns, [self.get_acceptable_values_for_field(c) for c in columns],
+                                                   dtype)
+        return self._search_spaces[key]
+
+    def generate_search_space_array(self, dtype: Optional[Union[str, np.dtype]] = None) -> np.ndarray:
+        """Generate the inputs for all possible values of the new samples as a single array
+
+        Builds the Cartesian product by broadcasting the acceptable values of each input
+        into one preallocated array, rather than creating a dictionary for each point.
+
+        Args:
+            dtype: Data type of the array. Defaults to the common type of all fields in ``inputs_dtype``
+        Returns:
+            2D array where each row is a point in the search space and the columns
+            are in the order given by :attr:`input_columns`. The array is read-only, as it is memoized
+        """
+        search_space = self.get_search_space(dtype)
+        key = search_space.dtype.str
+        if key not in self._search_space_arrays:
+            array = search_space.to_array()
+            array.flags.writeable = False
+            self._search_space_arrays[key] = array
+        return self._search_space_arrays[key]
+
+    def generate_search_space_dataframe(self, vectorized: bool = False) -> pd.DataFrame:
+        """Create the search space as a Pandas DataFrame
+
+        Args:
+            vectorized: Whether to build the search space from a single array with
+                :meth:`generate_search_space_array`. Much faster and uses far less memory,
+                but the columns are ordered by :attr:`input_columns` and share a single data type.
+        Returns:
+            Search space with a row per possible sample
+        """
+        if vectorized:
+            return pd.DataFrame(self.generate_search_space_array(), columns=self.input_columns, copy=False)
         return pd.DataFrame(list(self.generate_search_space()))
@@ -3,20 +3,29 @@
 We describe the policy for starting new runs by implementing a
 `Colmena <http://colmena.rtfd.org/>`_ Thinker class.
 """
+import asyncio
 import random
+from concurrent.futures import ThreadPoolExecutor as LocalThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Callable, Union
+from time import monotonic
+from typing import Dict, Callable, Union, Optional, List, Set, Sequence
+import shlex
+import sys
+import os
 
+import parsl
 import requests
 from colmena.redis.queue import ClientQueues, TaskServerQueues
 from colmena.task_server import ParslTaskServer
 from colmena.thinker import BaseThinker, agent
-from parsl import Config, ThreadPoolExecutor
-from pydantic import BaseModel, Field, AnyHttpUrl
+from parsl import Config, ThreadPoolExecutor, HighThroughputExecutor
+from parsl.providers import LocalProvider
+from pydantic import BaseModel, Field, AnyHttpUrl, PrivateAttr
 
-from polybot.sample import subscribe_to_study
-from polybot.models import SampleTemplate
-from polybot.robot import send_new_sample
+from polybot.config import settings
+from polybot.sample import subscribe_to_study, subscribe_to_study_async
+from polybot.models import Sample, SampleTemplate
+from polybot.robot import send_new_sample, AsyncRobotClient
 
 
 class OptimizationProblem(BaseModel):
@@ -27,6 +36,10 @@ class OptimizationProblem(BaseModel):
         ..., description="Path to the sample template. Defines the input variables and the search space"
                          " for the optimization. Can be either a path on the local filesystem or a HTTP URL")
 
+    search_template_ttl: float = Field(
+        60, description="How long to use a template downloaded from a HTTP URL before checking whether it has "
+                        "changed, in seconds. Templates from the local filesystem are checked on every access")
+
     # Options the planning algorithm
     planner_options: Dict = Field(default_factory=dict, description='Any options for the planning algorithm')
 
@@ -36,15 +49,59 @@ class OptimizationProblem(BaseModel):
     output: str = Field(..., description="Output variable. Name of values within the `processed_outputs` dictionary")
     maximize: bool = Field(True, description="Whether to maximize (or minimize) the target function")
 
+    # Cached copy of the search template
+    _template: Optional[SampleTemplate] = PrivateAttr(None)
+    _template_mtime: Optional[int] = PrivateAttr(None)  # Modification time of the template file
+    _template_validators: Dict[str, str] = PrivateAttr(default_factory=dict)  # Headers for revalidating a URL
+    _template_checked: Optional[float] = PrivateAttr(None)  # When the template was last downloaded or revalidated
+
     @property
     def search_template(self) -> SampleTemplate:
-        """Template that defines the sample search space"""
+        """Template that defines the sample search space
+
+        The template is read once and then cached. Files are re-read if their modification time changes,
+        and templates from URLs are revalidated using their ETag or Last-Modified headers
+        once the cached copy is older than :attr:`search_template_ttl`.
+        Treat the template as read-only, as it is shared between all users of this object.
+        """
         if isinstance(self.search_template_path, str):
-            # Download it to disk
-            reply = requests.get(self.search_template_path)
-            return SampleTemplate.parse_obj(reply.json())
+            self._update_template_from_url()
         else:
-            return SampleTemplate.parse_file(self.search_template_path)
+            self._update_template_from_file()
+        return self._template
+
+    def invalidate_search_template(self):
+        """Clear the cached search template, so that it is re-read on the next access"""
+        self._template = None
+        self._template_mtime = None
+        self._template_validators = {}
+        self._template_checked = None
+
+    def _update_template_from_file(self):
+        """Read the template from disk if it has changed since it was cached"""
+        mtime = Path(self.search_template_path).stat().st_mtime_ns
+        if self._template is None or mtime != self._template_mtime:
+            self._template = SampleTemplate.parse_file(self.search_template_path)
+            self._template_mtime = mtime
+
+    def _update_template_from_url(self):
+        """Download the template if it has changed since it was cached"""
+        # Skip if the cached copy is recent enough
+        now = monotonic()
+        if self._template is not None and now - self._template_checked < self.search_template_ttl:
+            return
+
+        # Make a conditional request if we have a cached copy
+        headers = self._template_validators if self._template is not None else {}
+        reply = requests.get(self.search_template_path, headers=headers)
+        if self._template is None or reply.status_code != 304:
+            self._template = SampleTemplate.parse_obj(reply.json())
+            self._template_validators = dict(
+                (request_key, reply.headers[reply_key])
+                for request_key, reply_key in [('If-None-Match', 'ETag'), ('If-Modified-Since', 'Last-Modified')]
+                if reply_key in reply.headers
+            )
+        self._template_checked = now
 
     class Config:
         extras = 'forbid'
@@ -78,6 +135,114 @@ class BasePlanner(BaseThinker):
         self.opt_spec = opt_spec
 
 
+class AsyncPlanner(BasePlanner):
+    """Base class for planners that run on an asyncio event loop
+
+    Receiving new samples, planning and sending new samples to the robot are all coroutines
+    that share a single event loop, which runs in an agent thread.
+    New samples are read from the Argonne Data Cloud continuously and queued, so none are missed
+    while the planner is busy.
+
+    Subclasses implement :meth:`on_new_sample`, which is called for each new sample in the order they arrive.
+    Run CPU-intensive work with :meth:`run_in_executor` and send samples with :meth:`submit_samples`
+    so that planning overlaps with receiving and submitting samples.
+
+    .. code: python
+
+        class MyPlanner(AsyncPlanner):
+
+            async def on_new_sample(self, sample: Sample):
+                new_sample = await self.run_in_executor(self.pick_next_sample, sample)
+                self.submit_samples([new_sample])
+    """
+
+    def __init__(self, queues: ClientQueues, opt_spec: OptimizationProblem, daemon: bool = False,
+                 max_workers: Optional[int] = None):
+        """
+        Args:
+            queues: Queues used to communicate with the task server
+            opt_spec: Definition of the optimization problem
+            daemon: Whether to launch the planner as a daemon thread
+            max_workers: Number of threads used to run CPU-intensive work
+        """
+        super().__init__(queues, opt_spec, daemon=daemon)
+        self.executor = LocalThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='planner-worker')
+        self.robot: Optional[AsyncRobotClient] = None  # Created on the event loop
+        self._submissions: Set[asyncio.Task] = set()
+
+    async def on_new_sample(self, sample: Sample):
+        """Respond to a new sample being completed
+
+        Args:
+            sample: Sample that was just completed
+        """
+        raise NotImplementedError()
+
+    async def run_in_executor(self, function: Callable, *args):
+        """Run a function in a separate thread, without blocking the event loop
+
+        Args:
+            function: Function to be run
+            args: Positional arguments to the function
+        Returns:
+            Output of the function
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def submit_samples(self, samples: List[Sample]) -> asyncio.Task:
+        """Send samples to the robot in the background
+
+        Args:
+            samples: Samples to be sent
+        Returns:
+            Task that is sending the samples. Errors are logged rather than raised
+        """
+        task = asyncio.get_running_loop().create_task(self._send_samples(samples))
+        self._submissions.add(task)
+        task.add_done_callback(self._submissions.discard)
+        return task
+
+    async def _send_samples(self, samples: List[Sample]):
+        try:
+            await self.robot.send_samples(samples)
+            self.logger.info(f'Sent {len(samples)} samples to the robot')
+        except Exception as exc:
+            self.logger.error(f'Failed to send samples to the robot: {exc}')
+
+    @agent()
+    def event_loop(self):
+        """Run the planner on an asyncio event loop until the planner is told to stop"""
+        asyncio.run(self._run_event_loop())
+
+    async def _run_event_loop(self):
+        self.robot = AsyncRobotClient()
+        received = asyncio.Queue()
+
+        # Receive new samples continuously
+        async def _receive_samples():
+            async for sample in subscribe_to_study_async():
+                self.logger.info(f'Received new sample: {sample.ID}')
+                await received.put(sample)
+        receiver = asyncio.get_running_loop().create_task(_receive_samples())
+
+        # Plan using each new sample until the planner is told to stop
+        try:
+            while not self.done.is_set():
+                try:
+                    sample = await asyncio.wait_for(received.get(), timeout=1)
+                except asyncio.TimeoutError:
+                    if receiver.done():
+                        receiver.result()  # Raises the exception from the subscription, if there is one
+                        return
+                    continue
+                await self.on_new_sample(sample)
+        finally:
+            receiver.cancel()
+            await asyncio.gather(*self._submissions)
+            await self.run_in_executor(self.robot.close)
+            self.executor.shutdown(wait=False)
+
+
 class RandomPlanner(BasePlanner):
     """Submit a randomly-selected point from the search space each time a new result is completed"""
 
@@ -88,10 +253,11 @@ class RandomPlanner(BasePlanner):
         for sample in subscribe_to_study():
             self.logger.info(f'Received new sample: {sample.ID}')
 
-            # Make a choice for each variable
-            output = self.opt_spec.search_template.create_new_sample()
-            for key, acceptable_values in self.opt_spec.search_template.list_acceptable_input_values().items():
-                output.inputs[key] = random.choice(acceptable_values)
+            # Pick a random point from the search space
+            template = self.opt_spec.search_template
+            search_space = template.get_search_space()
+            output = template.create_new_sample()
+            output.inputs.update(search_space.get_inputs(random.randrange(len(search_space))))
 
             # Send it to the robot
             send_new_sample(output)
@@ -120,3 +286,73 @@ def build_thread_pool_executor(queues: TaskServerQueues) -> ParslTaskServer:
         methods=[_execute],
         config=config
     )
+
+
+def make_process_pool_config(max_workers: Optional[int] = None, threads_per_worker: Optional[int] = None) -> Config:
+    """Make a Parsl configuration that runs tasks in a pool of processes on the local machine
+
+    Args:
+        max_workers: Number of worker processes. Defaults to ``settings.task_workers``, or one per core if that is not set
+        threads_per_worker: Number of threads used by the math libraries in each worker.
+            Defaults to ``settings.task_worker_threads``
+    Returns:
+        Parsl configuration
+    """
+    if max_workers is None:
+        max_workers = settings.task_workers or os.cpu_count()
+    if threads_per_worker is None:
+        threads_per_worker = settings.task_worker_threads
+
+    # Pin the number of threads used by the math libraries so that workers do not oversubscribe the cores
+    worker_init = [f'export {v}={threads_per_worker}' for v in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']]
+
+    # Start workers from the same Python environment, and let them import modules
+    #  from the launch directory (e.g., the task functions of the planner)
+    worker_init.append(f'export PATH={shlex.quote(os.path.dirname(sys.executable))}:$PATH')
+    worker_init.append(f'export PYTHONPATH={shlex.quote(os.getcwd())}:$PYTHONPATH')
+    return Config(executors=[
+        HighThroughputExecutor(
+            address='127.0.0.1',
+            max_workers=max_workers,
+            cores_per_worker=threads_per_worker,
+            provider=LocalProvider(init_blocks=1, max_blocks=1, worker_init='; '.join(worker_init))
+        )
+    ])
+
+
+class _ProcessPoolTaskServer(ParslTaskServer):
+    """Task server which stops its worker processes when it exits"""
+
+    def _cleanup(self):
+        super()._cleanup()
+        dfk = parsl.dfk()
+        dfk.cleanup()
+
+        # Parsl only stops the blocks whose workers have connected to it, so stop any that are still starting
+        for executor in dfk.executors.values():
+            provider = getattr(executor, 'provider', None)
+            if provider is None:
+                continue
+            running = [job_id for job_id, info in provider.resources.items() if not info.get('cancelled', False)]
+            if len(running) > 0:
+                provider.cancel(running)
+
+
+def build_process_pool_executor(queues: TaskServerQueues, methods: Sequence[Callable] = (_execute,)) -> ParslTaskServer:
+    """Builds a task server that runs tasks in parallel on a pool of local processes.
+
+    Unlike :meth:`build_thread_pool_executor`, tasks can use every core of the machine.
+    The number of workers and threads per worker are set using :meth:`make_process_pool_config`.
+
+    Args:
+        queues: Queues to use to communicate
+        methods: Methods to make available. Default is a single task, "execute," that receives
+            a Callable and executes it remotely
+    Returns:
+        A configured task server
+    """
+    return _ProcessPoolTaskServer(
+        queues=queues,
+        methods=list(methods),
+        config=make_process_pool_config()
+    )
@@ -1,5 +1,9 @@
 """Interface to the robot controller"""
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from typing import Callable, Optional, List, Iterable, Set
+import asyncio
 import logging
 
 import requests
@@ -21,6 +25,177 @@ def _check_if_robot_defined(function: Callable) -> Callable:
     return wrapper
 
 
+class RobotClient:
+    """Client for the robot controller
+
+    Keeps a persistent HTTP session so that connections are reused between requests,
+    and retries requests that fail because of connection problems or server errors.
+
+    Submissions are idempotent with respect to the sample ID. The client will not send a sample that
+    it has already sent successfully, and marks each request with an ``Idempotency-Key``
+    header so the controller can recognize retries of a request it already received.
+    """
+
+    def __init__(self, url: Optional[str] = None, timeout: Optional[float] = None,
+                 retries: Optional[int] = None, backoff: Optional[float] = None):
+        """
+        Args:
+            url: Address of the robot controller. Default is to use ``settings.robot_url``
+            timeout: Timeout for each request, in seconds. Default is ``settings.robot_timeout``
+            retries: Maximum number of times to retry a request. Default is ``settings.robot_retries``
+            backoff: Time to wait before the first retry, in seconds. Doubles with each subsequent retry.
+                Default is ``settings.robot_retry_backoff``
+        """
+        self._url = url
+        self.timeout = settings.robot_timeout if timeout is None else timeout
+        self.retries = settings.robot_retries if retries is None else retries
+        self.backoff = settings.robot_retry_backoff if backoff is None else backoff
+        self.session = requests.Session()
+
+        # IDs of samples that were sent successfully
+        self._sent_ids: Set[str] = set()
+        self._sent_lock = Lock()
+
+    @property
+    def url(self) -> Optional[str]:
+        """Address of the robot controller"""
+        return settings.robot_url if self._url is None else self._url
+
+    def close(self):
+        """Close the HTTP session"""
+        self.session.close()
+
+    def send_sample(self, sample: Sample) -> str:
+        """Send a new sample to be run by the PolyBot system
+
+        Args:
+            sample: Sample to be created on the Robot
+        Returns:
+            ID of the sample
+        """
+        # Check where to send the sample
+        if self.url is None:
+            raise ConnectionError('Robot URL is not defined')
+        elif self.url.lower().startswith('http://mock'):
+            logger.info('Mocking the robot controls')
+            return sample.ID
+
+        # Skip samples that have already been received
+        with self._sent_lock:
+            if sample.ID in self._sent_ids:
+                logger.info(f'Sample {sample.ID} was already sent to the robot. Skipping')
+                return sample.ID
+
+        # Send the request, retrying on connection problems or server errors
+        logger.info(f'Sending sample {sample.ID} to robot controller')
+        res = None
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.session.post(
+                    url=self.url.rstrip('/') + "/inputs/template",
+                    files={"file": (f'{sample.ID}.json', sample.json(), 'application/json')},
+                    headers={'Idempotency-Key': sample.ID},
+                    timeout=self.timeout
+                )
+                if res.status_code < 500:
+                    break
+                error = f'Server error {res.status_code}: {res.text}'
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if attempt == self.retries:
+                    raise
+                error = str(exc)
+            if attempt < self.retries:
+                wait_time = self.backoff * 2 ** attempt
+                logger.warning(f'Failed to send sample {sample.ID}: {error}. Retrying in {wait_time:.1f}s')
+                sleep(wait_time)
+
+        # Check if the result was received correctly
+        # TODO (wardlt): Does the system restore its own sample
+        if res.status_code != 200:
+            raise ValueError(f'Failure to send new sample. Error: {res.text}')
+        out = res.json()
+        if out['status'] != 'success':
+            raise ValueError(f'Failure to send new sample. Error: {out.get("error")}')
+        with self._sent_lock:
+            self._sent_ids.add(sample.ID)
+        return sample.ID
+
+    def send_samples(self, samples: Iterable[Sample]) -> List[str]:
+        """Send several new samples to be run by the PolyBot system
+
+        Samples are sent in the order provided over the same connection.
+
+        Args:
+            samples: Samples to be created on the Robot
+        Returns:
+            IDs of the samples
+        """
+        return [self.send_sample(sample) for sample in samples]
+
+
+class AsyncRobotClient:
+    """Client for the robot controller that can be used from an asyncio event loop
+
+    Runs the requests of a :class:`RobotClient` in a pool of threads, so that
+    waiting on the robot never blocks the event loop.
+    """
+
+    def __init__(self, client: Optional[RobotClient] = None, max_workers: int = 4):
+        """
+        Args:
+            client: Client used to make the requests. Default is to create a new one using ``settings``
+            max_workers: Maximum number of requests to run concurrently
+        """
+        self.client = RobotClient() if client is None else client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='robot-client')
+
+    def close(self):
+        """Wait for any requests to finish then release resources"""
+        self._executor.shutdown(wait=True)
+        self.client.close()
+
+    async def send_sample(self, sample: Sample) -> str:
+        """Send a new sample to be run by the PolyBot system
+
+        Args:
+            sample: Sample to be created on the Robot
+        Returns:
+            ID of the sample
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.client.send_sample, sample)
+
+    async def send_samples(self, samples: Iterable[Sample]) -> List[str]:
+        """Send several new samples to be run by the PolyBot system
+
+        Samples are sent concurrently.
+
+        Args:
+            samples: Samples to be created on the Robot
+        Returns:
+            IDs of the samples, in the order provided
+        """
+        return list(await asyncio.gather(*[self.send_sample(s) for s in samples]))
+
+
+# Client used by the module-level functions, created when first needed
+_client: Optional[RobotClient] = None
+_client_lock = Lock()
+
+
+def get_robot_client() -> RobotClient:
+    """Get the client shared by the functions in this module
+
+    Returns:
+        Client using the addresses and options from ``settings``
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RobotClient()
+        return _client
+
+
 @_check_if_robot_defined
 def send_new_sample(sample: Sample):
     """Send a new sample to be run by the PolyBot system
@@ -28,18 +203,16 @@ def send_new_sample(sample: Sample):
     Args:
         sample: Sample to be created on the Robot
     """
-    # Send the request
-    logger.info(f'Sending sample {sample.ID} to robot controller')
-    res = requests.post(
-        url=settings.robot_url + "/inputs/template",
-        files={"file": [f'{sample.ID}.json', sample.json(), 'application/json']}
-    )
-
-    # Check if the result was received correctly
-    # TODO (wardlt): Does the system restore its own sample
-    if res.status_code != 200:
-        raise ValueError(f'Failure to send new sample. Error: {res.text}')
-    out = res.json()
-    if out['status'] != 'success':
-        raise ValueError(f'Failure to send new sample. Error: {out.get("error")}')
-    return sample.ID
+    return get_robot_client().send_sample(sample)
+
+
+@_check_if_robot_defined
+def send_new_samples(samples: Iterable[Sample]) -> List[str]:
+    """Send several new samples to be run by the PolyBot system
+
+    Args:
+        samples: Samples to be created on the Robot, in the order they should be run
+    Returns:
+        IDs of the samples that were sent
+    """
+    return get_robot_client().send_samples(samples)
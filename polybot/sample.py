@@ -4,21 +4,40 @@ Note: We currently just save things to disk as JSON files.
 We will work with the "data infrastructure" team to figure out something better.
 """
 
+import asyncio
 import logging
-from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Lock, Thread
+from time import sleep, monotonic
+from typing import Iterator, Optional, Iterable, AsyncIterator, List
 
+import requests
 from adc_sdk.models import Sample as ADCSample
+from requests.adapters import HTTPAdapter
 
+from .cache import SampleFileCache
 from .config import settings
 from .models import Sample
+from .store import SampleStore
 
 
 logger = logging.getLogger(__name__)
 
+# Session used for downloading sample files, which is shared so that connections are reused
+_session: Optional[requests.Session] = None
+_session_lock = Lock()
 
-def subscribe_to_study() -> Iterator[Sample]:
+# Cache of sample files, which is created when first used
+_cache: Optional[SampleFileCache] = None
+_cache_lock = Lock()
+
+
+def subscribe_to_study(store: Optional[SampleStore] = None) -> Iterator[Sample]:
     """Subscribe to the "new sample" created event feed
 
+    Args:
+        store: Store to which new samples are added as they arrive
     Yields:
         Latest samples as they are created
     """
@@ -29,7 +48,113 @@ def subscribe_to_study() -> Iterator[Sample]:
         raise ValueError('The ADC study id is not set. Set your ADC_STUDY_ID environment variable.')
 
     for event in adc_client.subscribe_to_study(settings.adc_study_id):
-        yield _parse_sample(event.sample)
+        sample = _parse_sample(event.sample)
+        if store is not None:
+            store.add_sample(sample, adc_id=event.sample.id)
+        yield sample
+
+
+async def subscribe_to_study_async(store: Optional[SampleStore] = None) -> AsyncIterator[Sample]:
+    """Subscribe to the "new sample" created event feed from an asyncio event loop
+
+    Reads the event feed from a background thread, so that waiting for and downloading
+    new samples never blocks the event loop.
+
+    Args:
+        store: Store to which new samples are added as they arrive
+    Yields:
+        Latest samples as they are created
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end_of_feed = object()
+
+    def _put(item) -> bool:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+            return True
+        except RuntimeError:  # The event loop has closed
+            return False
+
+    def _read_feed():
+        try:
+            for sample in subscribe_to_study(store):
+                if not _put(sample):
+                    return
+        except Exception as exc:
+            _put(exc)
+        else:
+            _put(end_of_feed)
+
+    Thread(target=_read_feed, daemon=True, name='adc-subscription').start()
+    while True:
+        item = await queue.get()
+        if item is end_of_feed:
+            return
+        elif isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def coalesce_samples(samples: Iterator[Sample], debounce: float = 0,
+                     max_delay: Optional[float] = None) -> Iterator[List[Sample]]:
+    """Group samples that arrive close together in time
+
+    Reads samples in a background thread. Samples that arrive while the consumer
+    is busy with the previous group are combined into the next group,
+    so a burst of samples leads to a single follow-up group rather than one per sample.
+
+    Args:
+        samples: Stream of samples, such as from :meth:`subscribe_to_study`
+        debounce: Time to wait for more samples after each arrival before producing a group, in seconds
+        max_delay: Maximum time to wait after the first sample in a group before producing it, in seconds.
+            Default is to wait until no sample has arrived for ``debounce`` seconds
+    Yields:
+        Groups of samples in the order they arrived
+    """
+    queue = Queue()
+    end_of_feed = object()
+
+    def _read_samples():
+        try:
+            for sample in samples:
+                queue.put(sample)
+        except Exception as exc:
+            queue.put(exc)
+        else:
+            queue.put(end_of_feed)
+
+    Thread(target=_read_samples, daemon=True, name='sample-coalescer').start()
+
+    finished = False
+    error = None
+    while not finished:
+        # Wait for the first sample
+        group = []
+        item = queue.get()
+
+        # Collect samples until none arrive within the debounce window, or the maximum delay is reached
+        deadline = None if max_delay is None else monotonic() + max_delay
+        while True:
+            if item is end_of_feed:
+                finished = True
+                break
+            elif isinstance(item, Exception):
+                # Deliver the samples received before the error, then raise it
+                finished, error = True, item
+                break
+            group.append(item)
+
+            timeout = debounce if deadline is None else min(debounce, deadline - monotonic())
+            try:
+                item = queue.get(timeout=timeout) if timeout > 0 else queue.get_nowait()
+            except Empty:
+                break
+
+        if len(group) > 0:
+            yield group
+    if error is not None:
+        raise error
 
 
 def load_samples() -> Iterator[Sample]:
@@ -45,8 +170,101 @@ def load_samples() -> Iterator[Sample]:
         raise ValueError('The ADC study id is not set. Set your ADC_STUDY_ID environment variable.')
     study = adc_client.get_study(settings.adc_study_id)
 
-    for sample in study.samples:
-        yield _parse_sample(sample)
+    yield from _parse_samples(study.samples)
+
+
+def sync_study(store: SampleStore) -> int:
+    """Add any samples from the study that are missing from a local store
+
+    Only downloads the samples not yet in the store.
+
+    Args:
+        store: Store to be updated
+    Returns:
+        Number of samples added to the store
+    """
+
+    # Query to get the list of samples in the study
+    adc_client = settings.generate_adc_client()
+    if settings.adc_study_id is None:
+        raise ValueError('The ADC study id is not set. Set your ADC_STUDY_ID environment variable.')
+    study = adc_client.get_study(settings.adc_study_id)
+
+    # Download only the new samples
+    known_ids = store.known_ids()
+    new_records = [record for record in study.samples if record.id not in known_ids]
+    n_added = 0
+    for record, sample in zip(new_records, _parse_samples(new_records)):
+        n_added += store.add_sample(sample, adc_id=record.id)
+    logger.info(f'Added {n_added} new samples to the local store. {len(known_ids) + n_added} samples are now known')
+    return n_added
+
+
+def _get_session() -> requests.Session:
+    """Get the session used to download sample files
+
+    Returns:
+        A session with enough pooled connections for each download worker
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=settings.adc_download_workers)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _get_cache() -> Optional[SampleFileCache]:
+    """Get the cache for sample files
+
+    Returns:
+        The cache, or ``None`` if caching is not enabled
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.path != settings.sample_cache_dir:
+            _cache = settings.make_sample_cache()
+        return _cache
+
+
+def _download_sample(sample: ADCSample) -> str:
+    """Download the JSON associated with a sample record from ADC
+
+    Retries failed downloads, including those which time out, with exponential backoff.
+
+    Args:
+        sample: Sample information record from ADC
+    Returns:
+        Contents of the sample file
+    """
+    session = _get_session()
+    for attempt in range(settings.adc_download_retries + 1):
+        try:
+            reply = session.get(sample.url, verify=False, timeout=settings.adc_download_timeout)
+            reply.raise_for_status()
+            return reply.text
+        except requests.RequestException as exc:
+            if attempt == settings.adc_download_retries:
+                raise
+            wait_time = settings.adc_retry_backoff * 2 ** attempt
+            logger.warning(f'Download of sample {sample.id} failed: {exc}. Retrying in {wait_time:.1f}s')
+            sleep(wait_time)
+
+
+def _parse_samples(samples: Iterable[ADCSample]) -> Iterator[Sample]:
+    """Create Sample objects from many sample records from ADC
+
+    Downloads the sample files concurrently using up to ``settings.adc_download_workers`` threads.
+
+    Args:
+        samples: Sample information records from ADC
+    Yields:
+        Sample objects in the same order as the records
+    """
+    with ThreadPoolExecutor(settings.adc_download_workers) as executor:
+        yield from executor.map(_parse_sample, samples)
 
 
 def _parse_sample(sample: ADCSample) -> Sample:
@@ -57,8 +275,13 @@ def _parse_sample(sample: ADCSample) -> Sample:
     Returns:
         Sample object in the format created by polybot
     """
-    # Pull down the JSON associated with each sample
-    sample_data = sample.get_file(verify=False)
+    # Pull down the JSON associated with each sample, unless we have it already
+    cache = _get_cache()
+    sample_data = None if cache is None else cache.get(sample.id)
+    if sample_data is None:
+        sample_data = _download_sample(sample)
+        if cache is not None:
+            cache.put(sample.id, sample_data)
 
     # Parse as a sample object
     return Sample.parse_raw(sample_data)
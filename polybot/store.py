@@ -0,0 +1,170 @@
+"""Local, persistent storage of samples from a study
+
+Keeps a copy of every sample we have seen in a SQLite database so that
+planners need not download the entire study each time they build a training set.
+"""
+from pathlib import Path
+from threading import Lock
+from typing import Union, Optional, Iterator, Tuple, List, Callable, Set
+import sqlite3
+
+import numpy as np
+
+from .models import Sample, SampleCollection, parse_samples
+
+
+class SampleStore:
+    """Local copy of the samples from a study, backed by a SQLite database
+
+    Samples are kept in the order they are added to the store, and each is assigned
+    a sequence number so that users can retrieve only the samples added since they last checked.
+    Samples are identified by their ID in the Argonne Data Cloud (ADC) to make it
+    easy to find which samples from a study are not yet in the store.
+    """
+
+    def __init__(self, path: Union[str, Path], study_id: Optional[str] = None):
+        """
+        Args:
+            path: Path to the database. Will be created if it does not exist
+            study_id: ID of the study associated with these samples. A single database may hold many studies
+        """
+        self.path = Path(path)
+        self.study_id = study_id or ''
+        self._lock = Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS samples (
+                sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+                study_id TEXT NOT NULL,
+                adc_id TEXT NOT NULL,
+                sample_id TEXT,
+                data TEXT NOT NULL,
+                UNIQUE (study_id, adc_id)
+            )''')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM samples WHERE study_id=?', (self.study_id,)).fetchone()[0]
+
+    def __contains__(self, adc_id: str) -> bool:
+        with self._lock:
+            cur = self._conn.execute('SELECT 1 FROM samples WHERE study_id=? AND adc_id=?', (self.study_id, adc_id))
+            return cur.fetchone() is not None
+
+    def close(self):
+        """Close the connection to the database"""
+        self._conn.close()
+
+    def add_sample(self, sample: Sample, adc_id: Optional[str] = None) -> bool:
+        """Add a sample to the store, if it is not already present
+
+        Args:
+            sample: Sample to be added
+            adc_id: ID of the sample record in ADC. If not provided, uses the polybot sample ID
+        Returns:
+            Whether the sample was added
+        """
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                'INSERT OR IGNORE INTO samples (study_id, adc_id, sample_id, data) VALUES (?, ?, ?, ?)',
+                (self.study_id, adc_id or sample.ID, sample.ID, sample.json())
+            )
+            return cur.rowcount > 0
+
+    def known_ids(self) -> Set[str]:
+        """Get the ADC IDs of all samples in the store
+
+        Returns:
+            Set of ADC IDs
+        """
+        with self._lock:
+            cur = self._conn.execute('SELECT adc_id FROM samples WHERE study_id=?', (self.study_id,))
+            return {row[0] for row in cur}
+
+    @property
+    def last_sequence(self) -> int:
+        """Sequence number of the most-recently added sample. 0 if the store is empty"""
+        with self._lock:
+            cur = self._conn.execute('SELECT MAX(sequence) FROM samples WHERE study_id=?', (self.study_id,))
+            return cur.fetchone()[0] or 0
+
+    def iter_samples(self, after: int = 0, until: Optional[int] = None) -> Iterator[Tuple[int, Sample]]:
+        """Retrieve the samples in the order they were added
+
+        Args:
+            after: Only return samples with sequence numbers larger than this value
+            until: Only return samples with sequence numbers no larger than this value. ``None`` for no limit
+        Yields:
+            - Sequence number of the sample
+            - The sample
+        """
+        query = 'SELECT sequence, data FROM samples WHERE study_id=? AND sequence>?'
+        params = [self.study_id, after]
+        if until is not None:
+            query += ' AND sequence<=?'
+            params.append(until)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY sequence', params).fetchall()
+        # Samples were validated before being stored, so we need not validate them again
+        for (sequence, _), sample in zip(rows, parse_samples((data for _, data in rows), trusted=True)):
+            yield sequence, sample
+
+
+class IncrementalTrainingSet:
+    """Training set that is updated with only the samples added to a :class:`SampleStore` since the last update
+
+    Each sample is classified as either a successful measurement, which is added to the training set,
+    or a failed one, whose inputs are recorded separately.
+    Samples where the output is missing are not included in either.
+    """
+
+    def __init__(self, store: SampleStore, input_columns: List[str], output: str,
+                 find_failed: Optional[Callable[[SampleCollection], np.ndarray]] = None):
+        """
+        Args:
+            store: Store holding the samples
+            input_columns: Names of the inputs used as features
+            output: Name of the output, which must be in ``processed_output``
+            find_failed: Function that determines which samples in a collection are failed measurements.
+                Default is to treat all samples as successful
+        """
+        self.store = store
+        self.input_columns = list(input_columns)
+        self.output = output
+        self.find_failed = find_failed
+
+        # Samples loaded so far
+        self.last_sequence = 0
+        self.samples = SampleCollection()
+
+    def update(self, until: Optional[int] = None) -> int:
+        """Add any new samples from the store
+
+        Args:
+            until: Only add samples with sequence numbers no larger than this value. ``None`` to add all
+        Returns:
+            Number of new samples
+        """
+        new_samples = []
+        for sequence, sample in self.store.iter_samples(after=self.last_sequence, until=until):
+            new_samples.append(sample)
+            self.last_sequence = sequence
+        self.samples.extend(new_samples)
+        return len(new_samples)
+
+    def get_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the current training set
+
+        Returns:
+            - Input features for training set
+            - Output variable for training set
+            - Input features for failed samples
+        """
+        train_x = self.samples.get_inputs(self.input_columns)
+        train_y = self.samples.get_column(f'processed_output.{self.output}', dtype=float)
+        if self.find_failed is None:
+            failed = np.zeros((len(self.samples),), dtype=bool)
+        else:
+            failed = np.asarray(self.find_failed(self.samples), dtype=bool)
+        is_train = ~failed & ~np.isnan(train_y)
+        return train_x[is_train], train_y[is_train], train_x[failed]
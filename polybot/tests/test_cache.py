@@ -0,0 +1,57 @@
+"""Tests for the sample file cache"""
+import os
+
+from pytest_mock import MockerFixture
+
+from polybot.cache import SampleFileCache
+
+
+def test_cache(tmp_path):
+    cache = SampleFileCache(tmp_path, max_size=1024)
+    assert cache.get('a') is None
+
+    # Add a file
+    cache.put('a', 'a' * 256)
+    assert cache.get('a') == 'a' * 256
+    assert cache.total_size == 256
+
+    # Files with the same content are stored once
+    cache.put('b', 'a' * 256)
+    assert cache.get('b') == 'a' * 256
+    assert cache.total_size == 256
+
+    # Make sure the size is recovered when re-opening
+    assert SampleFileCache(tmp_path, max_size=1024).total_size == 256
+
+
+def test_evict(tmp_path):
+    cache = SampleFileCache(tmp_path, max_size=1024)
+    for i, name in enumerate('abcd'):
+        cache.put(name, name * 256)
+        object_path = next(p for p in (tmp_path / 'objects').glob('*.json') if p.read_text()[0] == name)
+        os.utime(object_path, (i, i))  # Ensure "a" is the oldest
+    assert cache.total_size == 1024
+
+    # Using "a" makes it the most-recently used, so "b" should be evicted
+    assert cache.get('a') is not None
+    cache.put('e', 'e' * 256)
+    assert cache.total_size == 1024
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+
+
+def test_corrupted(tmp_path):
+    cache = SampleFileCache(tmp_path, max_size=1024)
+    cache.put('a', 'a' * 256)
+    next((tmp_path / 'objects').glob('*.json')).write_text('b')
+    assert cache.get('a') is None
+    assert cache.total_size == 0
+
+
+def test_evicted_while_reading(tmp_path, mocker: MockerFixture):
+    cache = SampleFileCache(tmp_path, max_size=1024)
+    cache.put('a', 'a' * 256)
+
+    # Simulate another thread evicting the file after it was read
+    mocker.patch('polybot.cache.os.utime', side_effect=FileNotFoundError())
+    assert cache.get('a') is None
@@ -36,3 +36,12 @@ def test_planner():
 def test_planner_error():
     with raises(ValueError):
         main(['--verbose', 'planner', '-p', 'notARealPath', str(Path(__file__).parent / 'files' / 'opt_spec.json')])
+
+
+def test_planner_resume(tmp_path, mocker: MockerFixture):
+    # The random planner does not support resuming, which must be caught before launching the task server
+    build_fn = mocker.patch('polybot.planning.build_thread_pool_executor')
+    with raises(TypeError):
+        main(['--verbose', 'planner', '--timeout', '1', '-t', 'polybot.planning:build_thread_pool_executor',
+              '--resume', str(tmp_path), str(Path(__file__).parent / 'files' / 'opt_spec.json')])
+    assert build_fn.call_count == 0
@@ -1,4 +1,13 @@
 """Tests for the models"""
+import pickle
+import json
+
+import numpy as np
+from pydantic import ValidationError
+from pytest import raises, importorskip
+
+from polybot.models import Sample, SampleCollection, parse_samples
+from conftest import sample_path
 
 
 def test_generate_search_space(example_template):
@@ -17,3 +26,146 @@ def test_generate_sample(example_template):
 def test_sorted_inputs(example_template):
     cols = example_template.input_columns
     assert cols[0] < cols[1]
+
+
+def test_generate_search_space_array(example_template):
+    # Make sure it contains the same points as the dictionary-based version
+    data = example_template.generate_search_space_dataframe()[example_template.input_columns].values
+    array = example_template.generate_search_space_array()
+    assert array.shape == data.shape
+    assert array.flags['C_CONTIGUOUS']
+    assert np.allclose(array[np.lexsort(array.T)], data[np.lexsort(data.T)])
+
+    # Test the DataFrame wrapper
+    vec_data = example_template.generate_search_space_dataframe(vectorized=True)
+    assert list(vec_data.columns) == example_template.input_columns
+    assert np.allclose(vec_data.values, array)
+
+    # Test changing the dtype
+    assert example_template.generate_search_space_array(dtype='float32').dtype == np.float32
+
+
+def test_search_space(example_template):
+    search_space = example_template.get_search_space()
+    array = example_template.generate_search_space_array()
+    assert len(search_space) == len(array)
+    assert search_space.columns == example_template.input_columns
+
+    # Test random access
+    assert np.array_equal(search_space[5], array[5])
+    assert np.array_equal(search_space[-1], array[-1])
+    assert np.array_equal(search_space[10:20], array[10:20])
+    assert np.array_equal(search_space[[3, 1, 4]], array[[3, 1, 4]])
+    with raises(IndexError):
+        search_space[len(search_space)]
+
+    # Test chunked iteration
+    chunks = list(search_space.iter_chunks(len(array) // 3 + 1))
+    assert len(chunks) == 3
+    assert chunks[1][0] == len(array) // 3 + 1
+    assert np.array_equal(np.concatenate([c for _, c in chunks]), array)
+
+    # Test getting inputs for a single point
+    inputs = search_space.get_inputs(1)
+    assert list(inputs.keys()) == example_template.input_columns
+    assert np.allclose(list(inputs.values()), array[1])
+    assert isinstance(inputs['post_processing.sol'], int)
+
+    # Test sampling
+    indices = search_space.sample_indices(16, random_state=1)
+    assert len(set(indices)) == 16
+    assert indices.max() < len(search_space)
+
+    # Test finding points
+    assert np.array_equal(search_space.get_indices(array[indices]), indices)
+    assert np.array_equal(search_space.get_indices(array[:1] - 1e6), [-1])
+
+
+def test_memoize(example_template):
+    assert example_template.get_search_space() is example_template.get_search_space()
+    assert example_template.get_search_space('float32') is not example_template.get_search_space()
+    array = example_template.generate_search_space_array()
+    assert array is example_template.generate_search_space_array()
+    assert not array.flags.writeable
+
+    # Make sure the memoized values are not pickled
+    copy = pickle.loads(pickle.dumps(example_template))
+    assert len(pickle.dumps(example_template)) < 1e5
+    assert copy.get_search_space().shape == example_template.get_search_space().shape
+
+
+def test_parse_samples():
+    with open(sample_path) as fp:
+        payload = fp.read()
+    expected = Sample.parse_raw(payload)
+
+    # Test with and without validation
+    for trusted in [False, True]:
+        samples = parse_samples([payload, payload.encode(), json.loads(payload)], trusted=trusted)
+        assert len(samples) == 3
+        assert all(s.dict() == expected.dict() for s in samples)
+
+    # Make sure validation is skipped only when trusted
+    bad_payload = json.dumps({'ID': 'not-an-id'})
+    with raises(ValidationError):
+        parse_samples([bad_payload])
+    assert parse_samples([bad_payload], trusted=True)[0].ID == 'not-an-id'
+
+
+def test_serialize():
+    sample = Sample.parse_file(sample_path)
+    assert sample.json(indent=2).startswith('{\n')
+
+    # Make sure we can serialize numpy types
+    sample.inputs['numpy'] = np.float32(1)
+    sample.inputs['array'] = np.arange(2)
+    copy = Sample.parse_raw(sample.json())
+    assert copy.inputs['numpy'] == 1
+    assert copy.inputs['array'] == [0, 1]
+
+    # Make sure non-finite values are preserved, whether or not the output is formatted
+    sample.raw_output['values'] = [np.nan, np.inf, -np.inf, 1.]
+    for payload in [sample.json(), sample.json(indent=2)]:
+        for copy in [Sample.parse_raw(payload), parse_samples([payload])[0], parse_samples([payload], trusted=True)[0]]:
+            values = copy.raw_output['values']
+            assert np.isnan(values[0])
+            assert values[1:] == [np.inf, -np.inf, 1.]
+
+
+def test_sample_collection():
+    samples = [
+        Sample(inputs={'x.1': 1, 'y': 2}, processed_output={'z': 1, 'quality': {'defective': False}}),
+        Sample(inputs={'x.1': 2, 'y': 3}, processed_output={'z': 2, 'quality': {'defective': True}}),
+    ]
+    collection = SampleCollection(samples[:1])
+    assert collection.get_column('processed_output.quality.defective').tolist() == [False]
+
+    # Make sure cached columns are extended with new samples
+    collection.extend(samples[1:])
+    assert len(collection) == 2
+    assert collection.get_column('processed_output.quality.defective').tolist() == [False, True]
+    assert collection.get_column('inputs.x.1').tolist() == [1, 2]  # Keys with dots are matched
+    assert collection.get_column('raw_output.missing').tolist() == [None, None]
+    assert np.isnan(collection.get_column('raw_output.missing', dtype=float)).all()
+
+    # Test getting training sets
+    x, y = collection.to_arrays(['y', 'x.1'], 'processed_output.z')
+    assert x.tolist() == [[2, 1], [3, 2]]
+    assert y.tolist() == [1, 2]
+    x, y = collection.to_arrays(['y'], 'processed_output.z', filters={'processed_output.quality.defective': np.logical_not})
+    assert y.tolist() == [1]
+    collection.extend([Sample(inputs={'x.1': 3, 'y': 4})])
+    x, y = collection.to_arrays(['y'], 'processed_output.z')
+    assert y.tolist() == [1, 2]  # Skips missing output
+
+    # Test exporting
+    data = collection.to_dataframe()
+    assert list(data.columns) == ['ID', 'inputs.x.1', 'inputs.y', 'processed_output.z', 'processed_output.quality.defective']
+    assert len(data) == 3
+
+
+def test_parquet(tmp_path):
+    pq = importorskip('pyarrow.parquet')
+    collection = SampleCollection([Sample(inputs={'x': 1}, processed_output={'z': 1})])
+    collection.to_parquet(tmp_path / 'samples.parquet')
+    assert pq.read_table(tmp_path / 'samples.parquet').column_names == ['ID', 'inputs.x', 'processed_output.z']
@@ -1,5 +1,7 @@
 """Make sure the planning system works"""
+import asyncio
 import json
+import os
 import logging
 import time
 from time import sleep
@@ -8,8 +10,9 @@ from colmena.models import Result
 from pytest import fixture
 from pytest_mock import MockerFixture
 
-from polybot.models import SampleTemplate
-from polybot.planning import OptimizationProblem, RandomPlanner
+from polybot.models import Sample, SampleTemplate
+from polybot.planning import OptimizationProblem, RandomPlanner, AsyncPlanner, make_process_pool_config, \
+    build_process_pool_executor
 from polybot.config import settings
 
 from conftest import file_path
@@ -26,13 +29,54 @@ def opt_config() -> OptimizationProblem:
 
 def test_get_sample_from_url(mocker: MockerFixture):
     class _FakeResult:
+        status_code = 200
+        headers = {'ETag': '"v1"'}
+
         def json(self):
             with open(file_path / "example-template.json") as fp:
                 return json.load(fp)
 
-    mocker.patch('polybot.planning.requests.get', new=lambda x: _FakeResult())
+    class _NotModified:
+        status_code = 304
+        headers = {}
+
+    fake_get = mocker.patch('polybot.planning.requests.get', return_value=_FakeResult())
     opt = OptimizationProblem(search_template_path='http://fake.com/path', output='fake')
     assert isinstance(opt.search_template, SampleTemplate)
+    assert fake_get.call_count == 1
+
+    # Make sure it is cached
+    template = opt.search_template
+    assert opt.search_template is template
+    assert fake_get.call_count == 1
+
+    # Make sure it is revalidated after the cache expires
+    opt.search_template_ttl = 0
+    fake_get.return_value = _NotModified()
+    assert opt.search_template is template
+    assert fake_get.call_count == 2
+    assert fake_get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+    # Make sure it is downloaded again if invalidated
+    fake_get.return_value = _FakeResult()
+    opt.invalidate_search_template()
+    assert opt.search_template is not template
+    assert fake_get.call_args[1]['headers'] == {}
+
+
+def test_get_sample_from_file(tmp_path):
+    template_path = tmp_path / 'template.json'
+    template_path.write_text((file_path / "example-template.json").read_text())
+    opt = OptimizationProblem(search_template_path=template_path, output='fake')
+
+    # Make sure it is cached
+    template = opt.search_template
+    assert opt.search_template is template
+
+    # Make sure it is re-read if the file changes
+    mtime = template_path.stat().st_mtime
+    os.utime(template_path, (mtime + 1, mtime + 1))
+    assert opt.search_template is not template
 
 
 def test_generate(mocker: MockerFixture, mock_subscribe, opt_config, example_sample, caplog):
@@ -52,3 +96,77 @@ def test_generate(mocker: MockerFixture, mock_subscribe, opt_config, example_sam
     finally:
         # Kill the planning service
         planner.done.set()
+
+
+def test_async_planner(mocker: MockerFixture, opt_config):
+    # Make a fake subscription that produces several samples quickly
+    async def _fake_subscription():
+        for _ in range(4):
+            yield Sample()
+    mocker.patch('polybot.planning.subscribe_to_study_async', new=_fake_subscription)
+
+    # Make a fake robot
+    sent = []
+
+    class _FakeRobot:
+        async def send_samples(self, samples):
+            await asyncio.sleep(0.1)
+            sent.extend(samples)
+
+        def close(self):
+            pass
+    mocker.patch('polybot.planning.AsyncRobotClient', new=_FakeRobot)
+
+    class _Planner(AsyncPlanner):
+        received = []
+
+        async def on_new_sample(self, sample: Sample):
+            self.received.append(sample)
+            output = await self.run_in_executor(self.opt_spec.search_template.create_new_sample)
+            self.submit_samples([output])
+
+    # Run the planner until it runs out of samples
+    client_q = settings.make_client_queue()
+    planner = _Planner(client_q, opt_config, daemon=True)
+    planner.start()
+    planner.join(timeout=10)
+    assert len(planner.received) == 4
+    assert len(sent) == 4  # All submissions finish before exiting
+
+
+def test_process_pool_config():
+    settings.task_workers = 3
+    settings.task_worker_threads = 2
+    try:
+        executor = make_process_pool_config().executors[0]
+        assert executor.max_workers == 3
+        assert 'OMP_NUM_THREADS=2' in executor.provider.worker_init
+        assert os.getcwd() in executor.provider.worker_init
+
+        # Make sure arguments take precedence
+        executor = make_process_pool_config(max_workers=1, threads_per_worker=4).executors[0]
+        assert executor.max_workers == 1
+        assert 'OMP_NUM_THREADS=4' in executor.provider.worker_init
+    finally:
+        settings.task_workers = None
+        settings.task_worker_threads = 1
+
+
+def test_process_pool_executor():
+    settings.task_workers = 1
+    server = build_process_pool_executor(settings.make_server_queue())
+    client_q = settings.make_client_queue()
+    server.start()
+    try:
+        # Make sure the task runs in a worker process
+        client_q.send_inputs(os.getpid, method='_execute')
+        result = client_q.get_result(timeout=120)
+        assert result is not None and result.success, result
+        assert result.value != os.getpid()
+    finally:
+        # Stop the server and its workers, even if the task failed
+        client_q.send_kill_signal()
+        server.join(timeout=60)
+        server.kill()
+        settings.task_workers = None
+    assert server.exitcode == 0
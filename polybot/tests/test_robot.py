@@ -1,11 +1,20 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import List
 from unittest.mock import MagicMock
+import asyncio
+import json
 
+import requests
 from pytest_mock import MockerFixture
 from pytest import raises, fixture
 
-from polybot.robot import send_new_sample
+from polybot.models import Sample
+from polybot.robot import send_new_sample, send_new_samples, RobotClient, AsyncRobotClient
 from polybot.config import settings
 
+from conftest import sample_path
+
 
 @fixture()
 def mock_post(mocker: MockerFixture) -> MagicMock:
@@ -15,10 +24,40 @@ def mock_post(mocker: MockerFixture) -> MagicMock:
         def json(self):
             return {'status': 'success'}
 
-    mock = mocker.patch('requests.post', return_value=FakeReply())
+    mock = mocker.patch('requests.Session.post', return_value=FakeReply())
     return mock
 
 
+@fixture()
+def robot_server():
+    """Emulate the robot controller with a local HTTP server, which fails the first request"""
+    received: List[str] = []
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            received.append(self.headers['Idempotency-Key'])
+            if len(received) == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = json.dumps({'status': 'success'}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), _Handler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://localhost:{server.server_port}', received
+    server.shutdown()
+
+
 def test_submit(example_sample, mock_post):
     # Try without the robot URL defined
     with raises(ConnectionError):
@@ -29,7 +68,52 @@ def test_submit(example_sample, mock_post):
     send_new_sample(example_sample)
     assert mock_post.call_count == 1
 
+    # Send a batch
+    send_new_samples([Sample(), Sample()])
+    assert mock_post.call_count == 3
+
 
 def test_mock(example_sample):
     settings.robot_url = 'http://mock.com'
     send_new_sample(example_sample)
+
+
+def test_client(robot_server):
+    url, received = robot_server
+    client = RobotClient(url, timeout=5, retries=2, backoff=0)
+    sample = Sample.parse_file(sample_path)
+
+    # The first request fails, so it should be retried once
+    assert client.send_sample(sample) == sample.ID
+    assert received == [sample.ID] * 2
+
+    # Sending the same sample again should not contact the robot
+    client.send_sample(sample)
+    assert len(received) == 2
+
+    # Send a batch of new samples
+    batch = [Sample(), Sample()]
+    assert client.send_samples(batch) == [s.ID for s in batch]
+    assert received[2:] == [s.ID for s in batch]
+
+
+def test_client_failure(robot_server):
+    url, received = robot_server
+    client = RobotClient(url, timeout=5, retries=0, backoff=0)
+    with raises(ValueError):
+        client.send_sample(Sample())
+    assert len(received) == 1
+
+    # Make sure connection failures are raised
+    client = RobotClient('http://localhost:1', timeout=1, retries=1, backoff=0)
+    with raises(requests.ConnectionError):
+        client.send_sample(Sample())
+
+
+def test_async_client(robot_server):
+    url, received = robot_server
+    client = AsyncRobotClient(RobotClient(url, timeout=5, retries=2, backoff=0))
+    batch = [Sample(), Sample(), Sample()]
+    assert asyncio.run(client.send_samples(batch)) == [s.ID for s in batch]
+    assert set(received) == set(s.ID for s in batch)
+    client.close()
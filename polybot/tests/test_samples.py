@@ -1,7 +1,17 @@
+import asyncio
+from collections import Counter
 from pathlib import Path
+from time import sleep
+from typing import Optional
 
+from pytest import fixture, raises
+from pytest_mock import MockerFixture
+from requests import Response
+
+from polybot.config import settings
 from polybot.models import Sample
-from polybot.sample import load_samples, subscribe_to_study
+from polybot.sample import coalesce_samples, load_samples, subscribe_to_study, subscribe_to_study_async, sync_study
+from polybot.store import SampleStore
 
 _my_path = Path(__file__).parent
 
@@ -14,3 +24,121 @@ def test_subscribe(mock_subscribe):
 def test_load(example_sample):
     samples = list(load_samples())
     assert len(samples) >= 1
+
+
+class _FakeRecord:
+    """Emulates the sample records from ADC"""
+
+    def __init__(self, adc_id: str):
+        self.id = adc_id
+        self.url = f'https://fake.com/{adc_id}'
+
+
+class _FakeSession:
+    """Emulates downloading sample files. Fails the first download of each file"""
+
+    def __init__(self):
+        self.attempts = Counter()
+        self.timeouts = set()
+
+    def get(self, url: str, verify: bool = True, timeout: Optional[float] = None):
+        self.attempts[url] += 1
+        self.timeouts.add(timeout)
+        reply = Response()
+        if self.attempts[url] == 1:
+            reply.status_code = 503
+        else:
+            sample = Sample.parse_file(_my_path.joinpath('files', 'example-sample.json'))
+            sample.ID = url[-10:]  # Mark which record it came from
+            reply.status_code = 200
+            reply._content = sample.json().encode()
+        return reply
+
+
+@fixture()
+def fake_study(mocker: MockerFixture):
+    class _FakeStudy:
+        samples = [_FakeRecord(f'{i:010x}') for i in range(16)]
+
+    mocker.patch('polybot.sample.settings.adc_study_id', 'study')
+    mocker.patch('polybot.sample.settings.adc_retry_backoff', 0)
+    mocker.patch('polybot.config.ADCClient.get_study', return_value=_FakeStudy())
+    session = _FakeSession()
+    mocker.patch('polybot.sample._get_session', return_value=session)
+    return _FakeStudy, session
+
+
+def test_load_concurrent(fake_study):
+    study, session = fake_study
+    samples = list(load_samples())
+    assert [s.ID for s in samples] == [r.id for r in study.samples]  # Order is preserved
+    assert all(x == 2 for x in session.attempts.values())  # Each was retried once
+    assert session.timeouts == {settings.adc_download_timeout}
+
+
+def test_sync(fake_study, tmp_path):
+    study, session = fake_study
+    store = SampleStore(tmp_path / 'samples.db', 'study')
+    assert sync_study(store) == 16
+    assert store.known_ids() == set(r.id for r in study.samples)
+
+    # Make sure only new samples are downloaded
+    study.samples.append(_FakeRecord(f'{16:010x}'))
+    assert sync_study(store) == 1
+    assert sum(session.attempts.values()) == 34
+
+
+def test_load_cached(fake_study, mocker: MockerFixture, tmp_path):
+    study, session = fake_study
+    mocker.patch('polybot.sample.settings.sample_cache_dir', tmp_path)
+    samples = list(load_samples())
+    n_downloads = sum(session.attempts.values())
+
+    # The second load should read only from the cache
+    assert [s.ID for s in load_samples()] == [s.ID for s in samples]
+    assert sum(session.attempts.values()) == n_downloads
+
+
+def test_subscribe_async(mocker: MockerFixture):
+    samples = [Sample(), Sample()]
+    mocker.patch('polybot.sample.subscribe_to_study', return_value=iter(samples))
+
+    async def _read_all():
+        return [s async for s in subscribe_to_study_async()]
+    assert asyncio.run(_read_all()) == samples
+
+
+def test_coalesce():
+    def _burst_then_gap():
+        yield from [Sample(), Sample()]  # Arrive together
+        sleep(0.5)
+        yield Sample()  # Arrives after the debounce window
+
+    groups = list(coalesce_samples(_burst_then_gap(), debounce=0.2))
+    assert [len(g) for g in groups] == [2, 1]
+
+    # Samples that arrive while we are busy are combined
+    groups = coalesce_samples(_burst_then_gap(), debounce=0)
+    first_group = next(groups)
+    sleep(1)
+    remaining_groups = list(groups)
+    assert len(remaining_groups) == 1
+    assert len(first_group) + len(remaining_groups[0]) == 3
+
+    # Make sure the maximum delay is respected
+    def _steady_stream():
+        for _ in range(10):
+            yield Sample()
+            sleep(0.1)
+    groups = list(coalesce_samples(_steady_stream(), debounce=0.5, max_delay=0.25))
+    assert len(groups) > 1
+    assert sum(len(g) for g in groups) == 10
+
+    # Samples received before an error are delivered before it is raised
+    def _fail_after_sample():
+        yield Sample()
+        raise ValueError()
+    groups = coalesce_samples(_fail_after_sample(), debounce=0.2)
+    assert len(next(groups)) == 1
+    with raises(ValueError):
+        next(groups)
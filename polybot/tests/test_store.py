@@ -0,0 +1,72 @@
+"""Tests for the local sample store"""
+from pytest import fixture
+
+from polybot.models import Sample
+from polybot.store import SampleStore, IncrementalTrainingSet
+
+
+@fixture()
+def store(tmp_path) -> SampleStore:
+    return SampleStore(tmp_path / 'samples.db', study_id='study')
+
+
+def _make_sample(x: float, y: float) -> Sample:
+    return Sample(inputs={'x': x, 'z': -x}, processed_output={'y': y})
+
+
+def test_store(store, tmp_path):
+    sample = _make_sample(1, 2)
+    assert store.add_sample(sample, adc_id='a')
+    assert not store.add_sample(sample, adc_id='a')  # Already present
+    assert len(store) == 1
+    assert 'a' in store
+    assert store.known_ids() == {'a'}
+
+    # Make sure we can get only the new samples
+    first_sequence = store.last_sequence
+    store.add_sample(_make_sample(2, 3))
+    assert store.last_sequence > first_sequence
+    samples = list(store.iter_samples(after=first_sequence))
+    assert len(samples) == 1
+    assert samples[0][1].inputs['x'] == 2
+    assert [s.ID for _, s in store.iter_samples(until=first_sequence)] == [sample.ID]
+
+    # Make sure the data persist, but are kept separate between studies
+    store.close()
+    store = SampleStore(tmp_path / 'samples.db', study_id='study')
+    assert len(store) == 2
+    assert [s.ID for _, s in store.iter_samples()][0] == sample.ID
+    assert len(SampleStore(tmp_path / 'samples.db', study_id='other')) == 0
+
+
+def test_training_set(store):
+    train_set = IncrementalTrainingSet(store, ['z', 'x'], 'y',
+                                       find_failed=lambda c: c.get_column('processed_output.y', dtype=float) < 0)
+    assert train_set.update() == 0
+
+    store.add_sample(_make_sample(1, 2))
+    store.add_sample(_make_sample(2, -1))
+    assert train_set.update() == 2
+    train_x, train_y, failed_x = train_set.get_arrays()
+    assert train_x.tolist() == [[-1, 1]]
+    assert train_y.tolist() == [2]
+    assert failed_x.tolist() == [[-2, 2]]
+
+    # Make sure only new samples are added, and only up to the requested point
+    store.add_sample(_make_sample(3, 4))
+    last_sequence = store.last_sequence
+    store.add_sample(_make_sample(5, 6))
+    assert train_set.update(until=last_sequence) == 1
+    assert train_set.last_sequence == last_sequence
+    train_x, train_y, _ = train_set.get_arrays()
+    assert train_y.tolist() == [2, 4]
+    assert train_set.update() == 1
+    train_x, train_y, _ = train_set.get_arrays()
+    assert train_y.tolist() == [2, 4, 6]
+
+    # Make sure samples without the output are skipped
+    store.add_sample(Sample(inputs={'x': 4, 'z': -4}))
+    assert train_set.update() == 1
+    train_x, train_y, failed_x = train_set.get_arrays()
+    assert train_y.tolist() == [2, 4, 6]
+    assert len(failed_x) == 1